@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks
+    ==========
+
+    Measure the overhead MoreSQL adds on top of PostgreSQL.
+
+    Stored procedure calls go through the whole request path (argument
+    binding, execution, serialization and response building) using Flask's
+    test client, but the database is replaced by an in-process fake
+    psycopg2 driver returning synthetic result sets. No database is needed.
+
+    Usage::
+
+        $ python benchmarks.py                  # run all the scenarios
+        $ python benchmarks.py --large          # include the 1M rows one
+        $ python benchmarks.py --save base.json
+        $ python benchmarks.py --compare base.json
+
+    Each scenario runs in a forked process, so that its peak memory usage can
+    be measured on its own.
+"""
+
+import os
+import re
+import sys
+import time
+import timeit
+import datetime
+import optparse
+import resource
+import itertools
+import simplejson
+
+import flask
+import psycopg2.extensions
+
+import flask_moresql
+from flask_moresql import MoreSQL
+
+def _make_row(pos):
+    return {
+        'id': pos,
+        'weight': pos * 0.5,
+        'name': 'dog %d' % pos,
+        'good': pos % 2 == 0,
+        'added_on': datetime.datetime(2012, 1, 1, 12, 0, pos % 60),
+    }
+
+def _series(count):
+    def rows(args):
+        return itertools.imap(_make_row, xrange(count))
+    return rows
+
+# Synthetic result sets, by procedure name. Each function takes the
+# procedure arguments and returns an iterator over the rows.
+procedures = {
+    'get_scalar': lambda args: iter([ { 'get_scalar': 42 } ]),
+    'get_row': lambda args: iter([ _make_row(1) ]),
+    'sum_n_product': lambda args: iter([
+        { 'sum': args[0] + args[1], 'prod': args[0] * args[1] } ]),
+    'get_10k': _series(10000),
+    'get_1m': _series(1000000),
+}
+
+_procname_re = re.compile(r'FROM ([\w.]+)\(')
+
+class FakeCursor(object):
+    """A DB-API cursor returning the rows of the fake procedure found in the
+    executed statement."""
+
+    itersize = 2000
+    description = ()
+
+    def __init__(self, connection):
+        self.connection = connection
+        self._rows = iter([])
+
+    def execute(self, statement, args=None):
+        match = _procname_re.search(statement)
+        if match is not None:
+            self._rows = procedures[match.group(1)](args)
+            if not self.connection.autocommit:
+                self.connection.status = \
+                    psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+
+    def fetchone(self):
+        return next(self._rows, None)
+
+    def fetchmany(self, size=None):
+        return list(itertools.islice(self._rows, size or self.itersize))
+
+    def fetchall(self):
+        return list(self._rows)
+
+    def close(self):
+        pass
+
+class FakeConnection(object):
+    """A psycopg2-like connection, talking to no database."""
+
+    def __init__(self):
+        self.autocommit = False
+        self.closed = 0
+        self.status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        self.settings = { 'default_transaction_read_only': 'off' }
+        self.prepared = {}
+
+    def cursor(self, name=None, cursor_factory=None):
+        return FakeCursor(self)
+
+    def configure(self, settings):
+        for name, value in settings.items():
+            if value is None:
+                self.settings.pop(name, None)
+            else:
+                self.settings[name] = value
+
+    def restore(self):
+        self.settings = { 'default_transaction_read_only': 'off' }
+        self.autocommit = False
+
+    def get_transaction_status(self):
+        return self.status
+
+    def commit(self):
+        self.status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    rollback = commit
+
+    def close(self):
+        self.closed = 1
+
+class BenchmarkMoreSQL(MoreSQL):
+
+    def connect(self, creds):
+        return FakeConnection()
+
+def make_app():
+    app = flask.Flask(__name__)
+    app.config['MORESQL_DATABASE_URI'] = 'postgres://bench@localhost/bench'
+    app.config['MORESQL_INTROSPECTION'] = False
+    app.config['MORESQL_METRICS'] = True
+    # The fake driver returns Python values, not PostgreSQL ones
+    app.config['MORESQL_TYPECASTS'] = False
+    db = BenchmarkMoreSQL(app)
+
+    @app.route('/<procname>', methods=['GET'])
+    def call(procname):
+        fields = flask.request.values.get('fields')
+        return db.execute(procname,
+            fields=fields.split(',') if fields else None,
+            stream=flask.request.values.get('stream') == '1')
+
+    db.procedure('sum_n_product', [ 'x', 'y' ]).route('/handle/sum_n_product')
+
+    return app, db
+
+# Scenario name -> (URL, number of requests)
+scenarios = [
+    ('scalar', '/get_scalar', 5000),
+    ('row', '/get_row', 5000),
+    ('in_out', '/sum_n_product?x=10&y=32&fields=x,y', 5000),
+    ('in_out_handle', '/handle/sum_n_product?x=10&y=32', 5000),
+    ('setof_10k', '/get_10k', 20),
+    ('stream_10k', '/get_10k?stream=1', 20),
+]
+
+large_scenarios = [
+    ('setof_1m', '/get_1m', 1),
+    ('stream_1m', '/get_1m?stream=1', 1),
+]
+
+def _rss():
+    """Return the current resident set size, in kilobytes."""
+    with open('/proc/self/statm') as statm:
+        pages = int(statm.read().split()[1])
+    return pages * resource.getpagesize() // 1024
+
+def run_scenario(url, requests):
+    app, db = make_app()
+    client = app.test_client()
+
+    def request():
+        # Read the whole body, streamed responses included
+        rv = client.get(url, buffered=True)
+        if rv.status_code != 200:
+            raise RuntimeError("%s returned %d" % (url, rv.status_code))
+
+    # Warm up
+    request()
+    db.metrics = flask_moresql.Metrics()
+
+    rss = _rss()
+    start = time.time()
+    for _ in xrange(requests):
+        request()
+    elapsed = time.time() - start
+
+    stages = {}
+    for (procname, stage), histogram in db.metrics.stages.items():
+        stages[stage] = histogram.sum / histogram.count
+
+    return {
+        'requests_per_second': requests / elapsed,
+        'stages': stages,
+        'peak_memory_kb': max(0,
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss),
+    }
+
+def run_isolated(url, requests):
+    """Run the given scenario in a child process, and return its results."""
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        try:
+            result = simplejson.dumps(run_scenario(url, requests))
+        except Exception as e:
+            result = simplejson.dumps({ 'error': str(e) })
+        os.write(write, result)
+        os._exit(0)
+
+    os.close(write)
+    chunks = []
+    while True:
+        chunk = os.read(read, 65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    os.close(read)
+    os.waitpid(pid, 0)
+
+    result = simplejson.loads(''.join(chunks))
+    if 'error' in result:
+        raise RuntimeError(result['error'])
+    return result
+
+def run_micro():
+    """Time the request path helpers on their own, in microseconds per
+    call."""
+    app = flask.Flask(__name__)
+    results = {}
+
+    number = 100000
+    results['_convert_http_value'] = min(timeit.repeat(
+        lambda: flask_moresql._convert_http_value('42'),
+        number=number, repeat=3)) / number * 1e6
+
+    signature = flask_moresql.ProcedureSignature('sum_n', [
+        flask_moresql.Argument('x', 'int4', 'N', 'i'),
+        flask_moresql.Argument('y', 'int4', 'N', 'i'),
+    ], 'int4', False, 'v')
+
+    with app.test_request_context('/?x=10&y=32'):
+        fields = [ 'x', 'y' ]
+        results['_get_procedure_arguments'] = min(timeit.repeat(
+            lambda: flask_moresql._get_procedure_arguments(fields, None),
+            number=number, repeat=3)) / number * 1e6
+        results['_get_procedure_arguments (typed)'] = min(timeit.repeat(
+            lambda: flask_moresql._get_procedure_arguments(fields, None,
+                                                           [ signature ]),
+            number=number, repeat=3)) / number * 1e6
+
+    rows = [ _make_row(pos) for pos in xrange(1000) ]
+    number = 100
+    results['serialize 1k rows'] = min(timeit.repeat(
+        lambda: simplejson.dumps(rows, default=flask_moresql.dthandler),
+        number=number, repeat=3)) / number * 1e6
+
+    return results
+
+def report(results, baseline=None, threshold=0.2):
+    """Print the results, compared to the baseline if given. Return the
+    names of the benchmarks that regressed by more than `threshold`."""
+    regressions = []
+
+    def change(new, old, higher_is_better):
+        if not old:
+            return ''
+        ratio = float(new) / old - 1
+        if (ratio < -threshold) if higher_is_better else (ratio > threshold):
+            regressions.append(True)
+            return ' %+.1f%% REGRESSION' % (ratio * 100)
+        return ' %+.1f%%' % (ratio * 100)
+
+    baseline = baseline or { 'scenarios': {}, 'micro': {} }
+
+    out = sys.stdout
+    for name, result in results['scenarios'].items():
+        old = baseline['scenarios'].get(name, {})
+        out.write('%s\n' % name)
+        out.write('    requests/s   %12.1f%s\n' % (
+            result['requests_per_second'], change(
+                result['requests_per_second'],
+                old.get('requests_per_second'), True)))
+        out.write('    peak memory  %10d KB%s\n' % (
+            result['peak_memory_kb'], change(result['peak_memory_kb'],
+                                             old.get('peak_memory_kb'), False)))
+        for stage, seconds in sorted(result['stages'].items()):
+            out.write('    %-12s %10.1f us%s\n' % (stage, seconds * 1e6,
+                change(seconds, old.get('stages', {}).get(stage), False)))
+
+    for name, usecs in sorted(results['micro'].items()):
+        out.write('%-34s %8.2f us%s\n' % (name, usecs,
+            change(usecs, baseline['micro'].get(name), False)))
+
+    return regressions
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--large', action='store_true',
+                      help='include the 1M rows scenarios')
+    parser.add_option('--save', metavar='FILE',
+                      help='save the results as a baseline')
+    parser.add_option('--compare', metavar='FILE',
+                      help='compare the results with a saved baseline')
+    parser.add_option('--threshold', type='float', default=0.2,
+                      help='relative change considered as a regression '
+                           '[default: %default]')
+    options, args = parser.parse_args()
+
+    results = { 'scenarios': {}, 'micro': run_micro() }
+    for name, url, requests in scenarios + (
+            large_scenarios if options.large else []):
+        results['scenarios'][name] = run_isolated(url, requests)
+
+    baseline = None
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = simplejson.load(f)
+
+    regressions = report(results, baseline, options.threshold)
+
+    if options.save:
+        with open(options.save, 'w') as f:
+            simplejson.dump(results, f, indent=2)
+
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
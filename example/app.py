@@ -24,8 +24,10 @@ def dog(dog_id):
 
     # In case of GET requests, call get_dog(dog_id). Here dog_id is explicitly
     # passed to the stored procedure using the 'values' keyword argument.
+    # Results are cached until the dogs_changed trigger invalidates them.
     return db.execute(
-        'get_dog', fields=[ 'dog_id' ], values={ 'dog_id': dog_id })
+        'get_dog', fields=[ 'dog_id' ], values={ 'dog_id': dog_id },
+        cache=True)
 
 if __name__ == "__main__":
     app.run(debug=True)
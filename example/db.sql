@@ -32,5 +32,16 @@ BEGIN
 END;
 $$ LANGUAGE plpgsql;
 
+-- Evict cached results of get_dog and get_dogs whenever dogs are modified
+CREATE OR REPLACE FUNCTION notify_dogs_changed() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('moresql_invalidate', 'get_dog,get_dogs');
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER dogs_changed AFTER INSERT OR UPDATE OR DELETE ON dogs
+    FOR EACH STATEMENT EXECUTE PROCEDURE notify_dogs_changed();
+
 INSERT INTO dogs (weight, name, color) VALUES (2, 'Arturo', 'White');
 INSERT INTO dogs (weight, name, color) VALUES (5, 'Pluto', 'Black');
@@ -10,15 +10,58 @@
     :license: BSD, see LICENSE for more details.
 """
 
+import os
 import re
+import csv
+import sys
+import zlib
+import time
+import base64
+import bisect
+import heapq
+import random
+import select
+import hashlib
 import urllib
+import decimal
+import itertools
 import datetime
+import cStringIO
+import threading
+import contextlib
 import simplejson
 
 import psycopg2 
 import psycopg2.extras
+import psycopg2.extensions
 
-from flask import request, make_response
+from collections import namedtuple, defaultdict, OrderedDict
+from flask import request, make_response, stream_with_context, abort, \
+    has_request_context
+from flask.signals import Namespace
+
+try:
+    from flask import _app_ctx_stack as stack
+except ImportError:
+    from flask import _request_ctx_stack as stack
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import gevent.socket
+except ImportError:
+    gevent = None
+
+_signals = Namespace()
+
+#: Sent after each stored procedure call when metrics are enabled, with the
+#: procedure name, a dictionary of the seconds spent in each stage of the
+#: call, the number of rows returned, the size of the response and the
+#: exception raised, if any.
+procedure_executed = _signals.signal('procedure-executed')
 
 def parse_rfc1738_args(name):
     """Parse the given database URI and return a dictionary of database
@@ -64,6 +107,935 @@ def parse_rfc1738_args(name):
     del components['name']
     return components
 
+# Run-time parameters of fresh sessions, as tracked by _Connection.settings
+_session_defaults = { 'default_transaction_read_only': 'off' }
+
+class _Connection(psycopg2.extensions.connection):
+    """A psycopg2 connection keeping track of the run-time parameters set on
+    its session by MoreSQL."""
+
+    def __init__(self, *args, **kwargs):
+        super(_Connection, self).__init__(*args, **kwargs)
+        self.settings = dict(_session_defaults)
+
+        # Map statements prepared on this connection to their names, least
+        # recently used first
+        self.prepared = OrderedDict()
+
+    def configure(self, settings):
+        """Set the run-time parameters of the given dictionary which do not
+        already have the requested value, in a single round trip.
+        Parameters mapped to None are reset to their default value.
+        Parameters set in a transaction are lost if it is rolled back, so
+        this should be called in autocommit mode."""
+        statements, args = [], []
+        for name, value in sorted(settings.items()):
+            if self.settings.get(name) == value:
+                continue
+            if value is None:
+                statements.append('RESET %s' % name)
+            else:
+                statements.append('SET %s = %%s' % name)
+                args.append(value)
+
+        if statements:
+            self.cursor().execute('; '.join(statements), args)
+            for name, value in settings.items():
+                if value is None:
+                    self.settings.pop(name, None)
+                else:
+                    self.settings[name] = value
+
+    def restore(self):
+        """Reset the run-time parameters set by :meth:`configure`, such as the
+        transaction mode or statement timeout, and turn autocommit off, as
+        on a fresh connection, so that MoreSQL calls do not leak their
+        session state to code using the connection directly. The connection
+        must be idle."""
+        changed = [ name for name, value in self.settings.items()
+                    if _session_defaults.get(name) != value ]
+        if changed:
+            self.autocommit = True
+            self.cursor().execute(';'.join('RESET %s' % name
+                                           for name in changed))
+            self.settings = dict(_session_defaults)
+
+        self.autocommit = False
+
+# Transaction modes supported by MoreSQL.execute, as tuples of the session
+# read-only setting and the connection autocommit flag
+_transaction_modes = {
+    'commit': ('off', False),
+    'autocommit': ('off', True),
+    'readonly': ('on', True),
+}
+
+class PoolTimeout(RuntimeError):
+    """Raised when no pooled connection becomes available in time."""
+
+class CallTimeout(RuntimeError):
+    """Raised when a stored procedure call is cancelled for running past its
+    timeout."""
+
+class Overloaded(RuntimeError):
+    """Raised when a stored procedure has too many calls in flight."""
+
+class ResultTooLarge(RuntimeError):
+    """Raised when a stored procedure returns more rows or bytes than
+    allowed."""
+
+class ConnectionPool(object):
+    """A thread-safe pool of database connections.
+
+    Connections are created by calling `connect`. At least `minconn` of them
+    are opened upfront and at most `maxconn` are open at any given time.
+    Callers asking for a connection while all of them are checked out wait up
+    to `timeout` seconds, after which :class:`PoolTimeout` is raised.
+
+    Connections are health-checked when checked out: closed or broken
+    connections are transparently replaced. If `pre_ping` is true, a
+    ``SELECT 1`` round trip is additionally performed to detect connections
+    dropped by the server.
+
+    Connection attempts failing with :exc:`psycopg2.OperationalError`, as
+    when the server is restarting, are retried after `backoff` seconds, then
+    after twice as long and so on, up to `max_backoff` seconds between
+    attempts and `timeout` seconds overall. A `backoff` of 0 disables
+    retries.
+    """
+
+    def __init__(self, connect, minconn=1, maxconn=10, timeout=30,
+                 pre_ping=False, backoff=0.1, max_backoff=5):
+        if minconn > maxconn:
+            raise RuntimeError("Pool minimum size greater than maximum size")
+
+        self.connect = connect
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.pre_ping = pre_ping
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self._idle = []
+        self._size = 0
+        self._cond = threading.Condition()
+
+        self.warm_up(minconn)
+
+    @property
+    def size(self):
+        """Number of open connections, idle or checked out."""
+        return self._size
+
+    @property
+    def in_use(self):
+        """Number of connections currently checked out."""
+        return self._size - len(self._idle)
+
+    def getconn(self, timeout=None):
+        """Check a connection out of the pool, waiting at most `timeout`
+        seconds (default: the pool timeout) for one to become available."""
+        if timeout is None:
+            timeout = self.timeout
+
+        deadline = time.time() + timeout
+
+        while True:
+            conn = self._reserve(deadline, timeout)
+            if conn is None:
+                # A slot has been reserved for a brand new connection
+                return self._open(deadline)
+
+            if self._is_healthy(conn):
+                return conn
+
+            self._discard(conn)
+
+    def putconn(self, conn, close=False):
+        """Return a connection to the pool. Connections left in the middle of
+        a transaction are rolled back, broken ones are closed."""
+        if not close and not conn.closed:
+            status = conn.get_transaction_status()
+            if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                close = True
+            elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    close = True
+
+        if close or conn.closed:
+            self._discard(conn)
+            return
+
+        with self._cond:
+            self._idle.append(conn)
+            self._cond.notify()
+
+    def warm_up(self, count):
+        """Open new connections until at least `count` of them are open, or
+        the pool is full."""
+        count = min(count, self.maxconn)
+        while True:
+            with self._cond:
+                if self._size >= count:
+                    return
+                self._size += 1
+
+            conn = self._open(time.time() + self.timeout)
+            with self._cond:
+                self._idle.append(conn)
+                self._cond.notify()
+
+    def closeall(self):
+        """Close all idle connections."""
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._cond.notify_all()
+
+        for conn in idle:
+            if not conn.closed:
+                conn.close()
+
+    def _reserve(self, deadline, timeout):
+        """Wait for an idle connection or a free slot. Return the idle
+        connection, or None if a slot has been reserved."""
+        with self._cond:
+            while not self._idle and self._size >= self.maxconn:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise PoolTimeout(
+                        "No database connection available after %s seconds"
+                        % timeout)
+                self._cond.wait(remaining)
+
+            if self._idle:
+                return self._idle.pop()
+
+            self._size += 1
+            return None
+
+    def _open(self, deadline):
+        """Open a connection in a reserved slot, retrying until `deadline`.
+        The slot is released on failure."""
+        delay = self.backoff
+        try:
+            while True:
+                try:
+                    return self.connect()
+                except psycopg2.OperationalError:
+                    if not delay or time.time() + delay > deadline:
+                        raise
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_backoff)
+        except:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+    def _discard(self, conn):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+        if not conn.closed:
+            try:
+                conn.close()
+            except psycopg2.Error:
+                pass
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+
+        status = conn.get_transaction_status()
+        if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+
+        if not self.pre_ping:
+            return True
+
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1')
+            cursor.close()
+            if not conn.autocommit:
+                conn.rollback()
+        except psycopg2.Error:
+            return False
+
+        return True
+
+def _gevent_wait(conn, timeout=None):
+    """Wait for the given asynchronous connection to be ready, yielding to
+    other greenlets in the meantime."""
+    while True:
+        state = conn.poll()
+        if state == psycopg2.extensions.POLL_OK:
+            break
+        elif state == psycopg2.extensions.POLL_READ:
+            gevent.socket.wait_read(conn.fileno(), timeout=timeout)
+        elif state == psycopg2.extensions.POLL_WRITE:
+            gevent.socket.wait_write(conn.fileno(), timeout=timeout)
+        else:
+            raise psycopg2.OperationalError("Bad result from poll: %r" %
+                                            state)
+
+_wait_callbacks = {
+    'select': psycopg2.extras.wait_select,
+    'gevent': _gevent_wait,
+}
+
+#: Pools and connections inherited from parent processes
+_inherited = []
+
+#: Seconds queries are given to honour their statement_timeout, before being
+#: cancelled by the client
+_cancel_grace = 1
+
+class _Watchdog(object):
+    """Cancel the queries still running on connections past their deadline,
+    from a background thread."""
+
+    def __init__(self):
+        self._deadlines = []
+        self._watched = {}
+        self._keys = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def watch(self, conn, timeout):
+        """Cancel the query running on `conn` in `timeout` seconds, unless
+        :meth:`unwatch` is called with the returned key before."""
+        key = next(self._keys)
+        deadline = time.time() + timeout
+
+        with self._cond:
+            self._watched[key] = conn
+            heapq.heappush(self._deadlines, (deadline, key))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify()
+
+        return key
+
+    def unwatch(self, key):
+        with self._cond:
+            self._watched.pop(key, None)
+
+    def _run(self):
+        with self._cond:
+            while True:
+                # Forget about the queries which are over already
+                while self._deadlines and \
+                        self._deadlines[0][1] not in self._watched:
+                    heapq.heappop(self._deadlines)
+
+                if not self._deadlines:
+                    self._cond.wait()
+                    continue
+
+                deadline, key = self._deadlines[0]
+                remaining = deadline - time.time()
+                if remaining > 0:
+                    self._cond.wait(remaining)
+                    continue
+
+                heapq.heappop(self._deadlines)
+                conn = self._watched.pop(key)
+                # Cancel with the lock held, so that unwatch() does not
+                # return while the query may still be cancelled
+                try:
+                    conn.cancel()
+                except psycopg2.Error:
+                    pass
+
+_procname_re = re.compile(r'^[A-Za-z_][\w$]*(\.[A-Za-z_][\w$]*)?$')
+
+def _call_statement(procname, nargs):
+    """Return the SQL statement calling the given stored procedure with
+    `nargs` positional parameters."""
+    if not _procname_re.match(procname):
+        raise RuntimeError("Invalid stored procedure name '%s'" % procname)
+
+    return 'SELECT * FROM %s(%s)' % (procname, ', '.join([ '%s' ] * nargs))
+
+def _bind_bool(value):
+    lowered = value.strip().lower()
+    if lowered in ('t', 'true', 'y', 'yes', 'on', '1'):
+        return True
+    if lowered in ('f', 'false', 'n', 'no', 'off', '0'):
+        return False
+    raise ValueError("invalid boolean '%s'" % value)
+
+def _bind_json(value):
+    # Validate only: PostgreSQL parses the document itself
+    simplejson.loads(value)
+    return value
+
+def _bind_array(value):
+    result = simplejson.loads(value)
+    if not isinstance(result, list):
+        raise ValueError("JSON list expected")
+    return result
+
+# Converters from HTTP values to the Python type matching the given
+# PostgreSQL type. Values of other types are passed on as strings, and
+# parsed by PostgreSQL
+_binders = {
+    'int2': int,
+    'int4': int,
+    'int8': int,
+    'float4': float,
+    'float8': float,
+    'numeric': decimal.Decimal,
+    'bool': _bind_bool,
+    'json': _bind_json,
+    'jsonb': _bind_json,
+}
+
+Argument = namedtuple('Argument', 'name type category mode')
+
+class ProcedureSignature(object):
+    """The signature of a stored procedure, as found in pg_catalog.
+
+    :attr:`arguments` lists all the arguments of the procedure as
+    :class:`Argument` tuples of name, type name, type category and mode
+    (``'i'``, ``'o'``, ``'b'``, ``'v'`` or ``'t'`` as in
+    ``pg_proc.proargmodes``). :attr:`inputs` and :attr:`outputs` respectively
+    contain the arguments the procedure is called with and the ones it
+    returns.
+    """
+
+    _volatilities = { 'i': 'immutable', 's': 'stable', 'v': 'volatile' }
+
+    def __init__(self, name, arguments, return_type, returns_set, volatility,
+                 ndefaults=0):
+        self.name = name
+        self.arguments = arguments
+        self.return_type = return_type
+        self.returns_set = returns_set
+        self.volatility = self._volatilities.get(volatility, volatility)
+        self.ndefaults = ndefaults
+
+        self.inputs = [ arg for arg in arguments if arg.mode in 'ibv' ]
+        self.outputs = [ arg for arg in arguments if arg.mode in 'obt' ]
+
+        # Precompute the conversion function of each input argument
+        self.binders = [ _bind_array if arg.category == 'A' 
+            else _binders.get(arg.type) for arg in self.inputs ]
+
+    def accepts(self, nargs):
+        """Return True if the procedure can be called with `nargs`
+        positional arguments."""
+        return len(self.inputs) - self.ndefaults <= nargs <= len(self.inputs)
+
+    def bind(self, values):
+        """Convert the given HTTP values to the types of the input arguments.
+        Raise ValueError if a value cannot be converted."""
+        procargs = []
+        for pos, (binder, value) in enumerate(zip(self.binders, values)):
+            if binder is None:
+                procargs.append(value)
+                continue
+
+            try:
+                procargs.append(binder(value))
+            except (ValueError, ArithmeticError):
+                arg = self.inputs[pos]
+                raise ValueError("Invalid %s value for argument '%s' of %s" %
+                    (arg.type, arg.name or pos + 1, self.name))
+
+        return procargs
+
+def _match_signature(signatures, nargs):
+    """Return the only signature among the given overloads accepting `nargs`
+    arguments, or None."""
+    matching = [ sig for sig in signatures if sig.accepts(nargs) ]
+    if len(matching) == 1:
+        return matching[0]
+
+class ResultCache(object):
+    """A thread-safe LRU cache of serialized stored procedure results.
+
+    Entries are keyed on tuples whose first item is the procedure name, and
+    expire after the TTL given when storing them. When more than `maxsize`
+    entries are stored, the least recently used ones are evicted. The number
+    of cache hits and misses is counted in :attr:`hits` and :attr:`misses`.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Return the value cached under `key`, or None."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                self.misses += 1
+                return None
+
+            # Mark as most recently used
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl):
+        """Cache `value` under `key` for `ttl` seconds."""
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + ttl, value)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, procname=None):
+        """Evict the results of the given stored procedure, or all of them."""
+        with self._lock:
+            if procname is None:
+                self._entries.clear()
+                return
+
+            for key in self._entries.keys():
+                if key[0] == procname:
+                    del self._entries[key]
+
+# Serialize the rows returned by a procedure call on the server, applying the
+# same shaping rules as _unwrap(). Selecting from a subquery guarantees that
+# rows are JSON objects, even when the procedure returns a scalar type.
+_json_statements = {
+    'json': """
+        SELECT CASE
+            WHEN n <> 1 THEN coalesce(rows, '[]'::json)
+            WHEN (SELECT count(*) FROM json_object_keys(rows -> 0)) = 1
+                THEN (SELECT value FROM json_each(rows -> 0))
+            ELSE rows -> 0
+        END::text
+        FROM (SELECT json_agg(t) AS rows, count(*) AS n FROM (%s) t) r""",
+    'ndjson': """
+        SELECT coalesce(string_agg(row_to_json(t)::text || E'\\n', ''), '')
+        FROM (%s) t""",
+}
+
+def _json_statement(call, format):
+    """Return the SQL statement performing the given call statement and
+    returning its result as a `format` document."""
+    return _json_statements[format] % call
+
+class _Flight(object):
+    """A call in flight, and its outcome once done."""
+
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class Coalescer(object):
+    """Let concurrent identical calls share the result of a single one.
+
+    :attr:`calls` counts the calls actually performed, :attr:`coalesced` the
+    ones which waited for an identical call instead.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.coalesced = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def call(self, key, function):
+        """Call `function` and return a ``(result, shared)`` tuple. If a
+        call with the same `key` is already in flight, wait for it and share
+        its result, or exception, instead: `shared` is then true."""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+                self.calls += 1
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error[0], flight.error[1], flight.error[2]
+            return flight.result, True
+
+        try:
+            flight.result = function()
+        except:
+            flight.error = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+        return flight.result, False
+
+_statement_names = itertools.count()
+
+def _execute_statement(name, nargs):
+    if not nargs:
+        return 'EXECUTE %s' % name
+    return 'EXECUTE %s(%s)' % (name, ', '.join([ '%s' ] * nargs))
+
+def _execute_prepared(cursor, statement, args, maxsize):
+    """Execute `statement` through a server-side prepared statement, which is
+    created the first time the statement is executed on the connection. At
+    most `maxsize` statements are kept per connection, the least recently
+    used ones are deallocated first."""
+    conn = cursor.connection
+
+    name = conn.prepared.pop(statement, None)
+    if name is not None:
+        idle = conn.autocommit or conn.get_transaction_status() == \
+            psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        try:
+            cursor.execute(_execute_statement(name, len(args)), args)
+            conn.prepared[statement] = name
+            return
+        except psycopg2.Error as e:
+            # Unless the statement has been deallocated behind our back, and
+            # the call can be safely repeated, there is nothing to retry
+            if e.pgcode != '26000' or not idle:
+                raise
+
+            conn.prepared.clear()
+            if not conn.autocommit:
+                conn.rollback()
+
+    # Deallocate, prepare and execute in a single round trip
+    queries = []
+    while len(conn.prepared) >= maxsize:
+        queries.append('DEALLOCATE %s' % conn.prepared.popitem(last=False)[1])
+
+    name = 'moresql_%d' % next(_statement_names)
+    params = tuple([ '$%d' % (pos + 1) for pos in range(len(args)) ])
+    queries.append('PREPARE %s AS %s' % (name,
+        (statement % params).replace('%', '%%')))
+    queries.append(_execute_statement(name, len(args)))
+
+    # Prepared statements are not transactional: the statement outlives a
+    # failed execution, and has to be tracked for reuse or deallocation
+    conn.prepared[statement] = name
+    cursor.execute('; '.join(queries), args)
+
+_default_buckets = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5,
+                    10)
+
+class Histogram(object):
+    """A histogram of observed values, counted in buckets of the given upper
+    bounds as in Prometheus histograms."""
+
+    def __init__(self, buckets=_default_buckets):
+        self.buckets = buckets
+        # The last bucket counts values above all bounds
+        self.counts = [ 0 ] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Metrics(object):
+    """Metrics of the stored procedure calls performed by MoreSQL.
+
+    :attr:`stages` maps ``(procname, stage)`` tuples to a :class:`Histogram`
+    of the seconds spent in that stage of the calls. Stages are ``pool``
+    (waiting for a connection), ``bind``, ``call``, ``commit``, ``fetch``,
+    ``copy`` (bulk loading rows), ``serialize``, ``compress``, ``send``
+    (writing streamed responses), ``cache`` (serving a cached result),
+    ``coalesce`` (waiting for an identical call in flight) and ``total``.
+    :attr:`calls`, :attr:`errors`, :attr:`rows` and :attr:`bytes` map
+    procedure names to the number of calls, failed calls, rows returned and
+    response bytes.
+    """
+
+    def __init__(self, buckets=_default_buckets):
+        self.buckets = buckets
+        self.stages = {}
+        self.calls = defaultdict(int)
+        self.errors = defaultdict(int)
+        self.rows = defaultdict(int)
+        self.bytes = defaultdict(int)
+
+        self._lock = threading.Lock()
+
+    def record(self, procname, timings, rows=None, size=None, error=None):
+        """Record a call to the given stored procedure."""
+        with self._lock:
+            self.calls[procname] += 1
+            if error is not None:
+                self.errors[procname] += 1
+            if rows:
+                self.rows[procname] += rows
+            if size:
+                self.bytes[procname] += size
+
+            for stage, seconds in timings.iteritems():
+                histogram = self.stages.get((procname, stage))
+                if histogram is None:
+                    histogram = self.stages[procname, stage] = \
+                        Histogram(self.buckets)
+                histogram.observe(seconds)
+
+    def prometheus(self):
+        """Return all metrics in the Prometheus text exposition format."""
+        lines = [
+            '# HELP moresql_stage_seconds Time spent in each stage of '
+                'stored procedure calls.',
+            '# TYPE moresql_stage_seconds histogram',
+        ]
+
+        with self._lock:
+            for (procname, stage), histogram in sorted(self.stages.items()):
+                labels = 'procedure="%s",stage="%s"' % (procname, stage)
+                cumulative = 0
+                bounds = [ repr(float(b)) for b in histogram.buckets ]
+                for bound, count in zip(bounds + [ '+Inf' ], histogram.counts):
+                    cumulative += count
+                    lines.append('moresql_stage_seconds_bucket{%s,le="%s"} %d'
+                                 % (labels, bound, cumulative))
+                lines.append('moresql_stage_seconds_sum{%s} %r' %
+                             (labels, float(histogram.sum)))
+                lines.append('moresql_stage_seconds_count{%s} %d' %
+                             (labels, histogram.count))
+
+            for name, counters, help in [
+                    ('calls', self.calls, 'Stored procedure calls.'),
+                    ('errors', self.errors, 'Failed stored procedure calls.'),
+                    ('rows', self.rows, 'Rows returned by stored procedures.'),
+                    ('response_bytes', self.bytes, 'Size of responses.')]:
+                lines.append('# HELP moresql_%s_total %s' % (name, help))
+                lines.append('# TYPE moresql_%s_total counter' % name)
+                for procname, value in sorted(counters.items()):
+                    lines.append('moresql_%s_total{procedure="%s"} %d' %
+                                 (name, procname, value))
+
+        return '\n'.join(lines) + '\n'
+
+class _Timer(object):
+    """Measure the time spent in each stage of a stored procedure call, and
+    record it when the call is over."""
+
+    def __init__(self, app, metrics, procname, slow=None, on_slow=None):
+        self.app = app
+        self.metrics = metrics
+        self.procname = procname
+        self.slow = slow
+        self.on_slow = on_slow
+
+        self.timings = {}
+        self.rows = None
+        self.size = None
+        self.arguments = None
+        self.mode = None
+        self.statement = None
+        self.pool = None
+        self.deferred = False
+        self.start = self.last = time.time()
+
+    def mark(self, stage):
+        """Account the time elapsed since the previous mark to `stage`."""
+        now = time.time()
+        self.timings[stage] = self.timings.get(stage, 0) + now - self.last
+        self.last = now
+
+    def count(self, rows=None, size=None):
+        if rows is not None:
+            self.rows = (self.rows or 0) + rows
+        if size is not None:
+            self.size = (self.size or 0) + size
+
+    def describe(self, names, procargs, mode, statement):
+        """Remember the arguments and statement of the call, logged if it
+        turns out to be slow."""
+        self.arguments = (names, procargs)
+        self.mode = mode
+        self.statement = statement
+
+    def defer(self):
+        """Do not record the call when leaving the with block, the caller
+        takes care of calling :meth:`finish`."""
+        self.deferred = True
+
+    def finish(self, error=None):
+        self.timings['total'] = time.time() - self.start
+        if self.metrics is not None:
+            self.metrics.record(self.procname, self.timings, self.rows,
+                                self.size, error)
+            procedure_executed.send(self.app, procname=self.procname,
+                                    timings=self.timings, rows=self.rows,
+                                    size=self.size, error=error)
+        if self.slow is not None and self.timings['total'] >= self.slow:
+            self.on_slow(self, error)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.finish(exc_value)
+        elif not self.deferred:
+            self.finish()
+
+class _NullTimer(object):
+    """A do-nothing :class:`_Timer`, used when metrics and the slow call log
+    are disabled."""
+
+    __slots__ = ()
+
+    slow = None
+
+    def mark(self, stage):
+        pass
+
+    def count(self, rows=None, size=None):
+        pass
+
+    def defer(self):
+        pass
+
+    def finish(self, error=None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+_null_timer = _NullTimer()
+
+def _cast_text(value, cursor):
+    return value
+
+def _cast_timestamp(value, cursor):
+    if value is None:
+        return None
+    return value.replace(' ', 'T', 1)
+
+def _cast_timestamptz(value, cursor):
+    if value is None:
+        return None
+    value = value.replace(' ', 'T', 1)
+    # PostgreSQL leaves the minutes out of whole hour offsets
+    if value[-3] in '+-':
+        value += ':00'
+    return value
+
+def _cast_json(value, cursor):
+    if value is None:
+        return None
+    # Passed on as is, without being decoded and encoded again
+    return simplejson.RawJSON(value)
+
+def _numeric_caster(convert):
+    def cast(value, cursor):
+        if value is None:
+            return None
+        return convert(value)
+    return cast
+
+_numeric_casts = {
+    'decimal': _numeric_caster(decimal.Decimal),
+    'float': _numeric_caster(float),
+    'string': _cast_text,
+}
+
+# Functions casting values of the given type OIDs, and the OIDs of their arrays
+_typecasts = [
+    # date, time, interval and uuid values are left as PostgreSQL prints them
+    ('TEXT', (1082, 1083, 1186, 2950), (1182, 1183, 1187, 2951), _cast_text),
+    ('TIMESTAMP', (1114,), (1115,), _cast_timestamp),
+    ('TIMESTAMPTZ', (1184, 1266), (1185, 1270), _cast_timestamptz),
+    ('JSON', (114, 3802), (199, 3807), _cast_json),
+    ('NUMERIC', (1700,), (1231,), None),
+]
+
+def _typecasters(numeric):
+    """Return the psycopg2 typecasters decoding PostgreSQL values straight
+    to types :mod:`simplejson` serializes natively, numeric values being
+    decoded as `numeric` (``'decimal'``, ``'float'`` or ``'string'``)."""
+    if numeric not in _numeric_casts:
+        raise RuntimeError("Unsupported numeric type '%s'" % numeric)
+
+    typecasters = []
+    for name, oids, array_oids, cast in _typecasts:
+        caster = psycopg2.extensions.new_type(oids, 'MORESQL_' + name,
+                                              cast or _numeric_casts[numeric])
+        typecasters.append(caster)
+        typecasters.append(psycopg2.extensions.new_array_type(array_oids,
+            'MORESQL_%sARRAY' % name, caster))
+    return typecasters
+
+def _argument_names(fields, values, view_args=None):
+    """Return the names of the fields passed to the stored procedure, in
+    the order of :func:`_get_procedure_arguments`."""
+    if fields is None:
+        return []
+    if values:
+        return list(fields)
+    return [ field for field in fields if (view_args and field in view_args)
+             or request.values.get(field) is not None ]
+
+_redacted = '[redacted]'
+
+# Session settings making auto_explain send the plans of all the statements
+# run by a stored procedure to the client, as notices
+_auto_explain_settings = [
+    "auto_explain.log_min_duration = 0",
+    "auto_explain.log_analyze = on",
+    "auto_explain.log_buffers = on",
+    "auto_explain.log_nested_statements = on",
+    "auto_explain.log_level = notice",
+]
+
+def _explain(conn, statement, args):
+    """Run the given statement and return the list of its plans, with
+    execution statistics. auto_explain reports the statements run within
+    the stored procedure, if it can be loaded; otherwise only the plan of
+    the statement itself is reported. Changes are rolled back."""
+    cursor = conn.cursor()
+    try:
+        cursor.execute("LOAD 'auto_explain'")
+        for setting in _auto_explain_settings:
+            cursor.execute('SET LOCAL ' + setting)
+    except psycopg2.Error:
+        # Not installed, not allowed, or PostgreSQL older than 12
+        conn.rollback()
+    else:
+        del conn.notices[:]
+        cursor.execute(statement, args)
+        conn.rollback()
+        return [ notice.strip() for notice in conn.notices
+                 if 'plan:' in notice ]
+
+    cursor.execute('EXPLAIN (ANALYZE, BUFFERS) ' + statement, args)
+    plan = '\n'.join([ row[0] for row in cursor.fetchall() ])
+    conn.rollback()
+    return [ plan ]
+
 def _convert_http_value(value):
     """Try to parse the given JSON value. Return raw value on failure."""
     try:
@@ -71,24 +1043,429 @@ def _convert_http_value(value):
     except simplejson.JSONDecodeError:
         return value
 
-def _get_procedure_arguments(fields, values):
-    """Return a list of parameters to be passed to the stored procedure."""
+def _get_procedure_arguments(fields, values, signatures=(), view_args=None):
+    """Return a list of parameters to be passed to the stored procedure,
+    together with the matching signature among the given ones (if any).
+    `view_args` are URL variables, taking precedence over HTTP values."""
     if fields is None:
         # The stored procedure has been called without parameters
-        return []
+        return [], _match_signature(signatures, 0)
 
     if values:
         # Use user-supplied values
-        return [ values.get(field) for field in fields ]
+        procargs = [ values.get(field) for field in fields ]
+        return procargs, _match_signature(signatures, len(procargs))
 
     # Use HTTP request values
-    return [ _convert_http_value(request.values.get(field)) 
-        for field in fields if request.values.get(field) is not None ]
+    get = request.values.get
+    if view_args:
+        raw = [ unicode(view_args[field]) if field in view_args
+                else get(field) for field in fields ]
+    else:
+        raw = map(get, fields)
+    raw = [ value for value in raw if value is not None ]
+
+    signature = _match_signature(signatures, len(raw))
+    if signature is None:
+        return [ _convert_http_value(value) for value in raw ], None
+
+    return signature.bind(raw), signature
+
+def _unwrap(rows):
+    """Apply the result shaping rules of :meth:`MoreSQL.execute`: a single
+    row is returned as such rather than as a list, and the value of a single
+    row with a single column is returned alone."""
+    if len(rows) == 1:
+        if len(rows[0]) == 1:
+            return rows[0].values()[0]
+        return rows[0]
+    return rows
 
 def dthandler(obj):
     if isinstance(obj, datetime.datetime):
         return obj.isoformat()
 
+def _page_statement(call, columns, descending, after):
+    """Return the SQL statement fetching a page of the rows returned by the
+    given call statement, ordered by `columns` and following the row whose
+    keys are `after`, if any. The last parameter is the page size."""
+    statement = call
+
+    if after is not None:
+        statement += ' WHERE (%s) %s (%s)' % (', '.join(columns),
+            '<' if descending else '>', ', '.join([ '%s' ] * len(columns)))
+
+    order = ' DESC' if descending else ''
+    return statement + ' ORDER BY %s LIMIT %%s' % ', '.join([ column + order
+        for column in columns ])
+
+def _serialize(rows, format, cursor):
+    """Return the `format` document holding the given rows, fetched by
+    `cursor`, shaped as :meth:`MoreSQL.execute` does."""
+    if format == 'json':
+        return simplejson.dumps(_unwrap(rows), default=dthandler)
+    if format == 'msgpack':
+        return msgpack.packb(_unwrap(rows), default=_msgpack_default,
+                             use_bin_type=True)
+    return _document_start(format, _columns(cursor)) + \
+        _dump_rows(rows, format) + _document_ends.get(format, '')
+
+def _dump_batch(rows, format, first=True):
+    """Serialize a batch of rows as a fragment of a `format` document, as
+    :func:`_dump_rows` does. MessagePack fragments are the concatenation of
+    the rows, to be preceded by an array header."""
+    if format == 'msgpack':
+        return ''.join([ msgpack.packb(row, default=_msgpack_default,
+                                       use_bin_type=True) for row in rows ])
+    return _dump_rows(rows, format, first)
+
+class _LimitedDocument(object):
+    """A `format` document built out of batches of rows, holding at most
+    `max_rows` rows and `max_bytes` bytes. Rows past these limits are
+    dropped, and :attr:`exceeded` tells which limit was exceeded."""
+
+    def __init__(self, format, max_rows=None, max_bytes=None):
+        self.format = format
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+
+        self.parts = []
+        self.first = None
+        self.count = 0
+        self.size = 0
+        self.exceeded = None
+
+    def add(self, rows):
+        """Add a batch of rows. Return False once a limit is exceeded."""
+        format, max_rows, max_bytes = self.format, self.max_rows, self.max_bytes
+        if self.first is None:
+            self.first = rows
+
+        if max_rows is not None and self.count + len(rows) > max_rows:
+            self.exceeded = "more than %d rows" % max_rows
+            rows = rows[:max_rows - self.count]
+
+        part = _dump_batch(rows, format, self.count == 0)
+        if max_bytes is not None and self.size + len(part) > max_bytes:
+            self.exceeded = "more than %d bytes" % max_bytes
+            # Keep the rows which fit, one at a time
+            part = ''
+            for pos, row in enumerate(rows):
+                row = _dump_batch([ row ], format, self.count + pos == 0)
+                if self.size + len(part) + len(row) > max_bytes:
+                    rows = rows[:pos]
+                    break
+                part += row
+
+        self.parts.append(part)
+        self.count += len(rows)
+        self.size += len(part)
+        return self.exceeded is None
+
+    def body(self, columns=None):
+        """Return the document, given the column names of tuple formats."""
+        format = self.format
+        if self.count == 1 and self.exceeded is None and \
+                format in ('json', 'msgpack'):
+            # A single row is unwrapped as usual
+            return _serialize(self.first[:1], format, None)
+        if format == 'msgpack':
+            return msgpack.Packer().pack_array_header(self.count) + \
+                ''.join(self.parts)
+        return _document_start(format, columns) + ''.join(self.parts) + \
+            _document_ends.get(format, '')
+
+def _encode_token(keys):
+    """Return the opaque continuation token of a page ending with a row
+    with the given keys."""
+    return base64.urlsafe_b64encode(
+        simplejson.dumps(keys, default=dthandler)).rstrip('=')
+
+def _decode_token(token, nkeys):
+    """Return the keys encoded in the given continuation token. Raise
+    ValueError if the token is invalid."""
+    try:
+        token = str(token)
+        keys = simplejson.loads(base64.urlsafe_b64decode(
+            token + '=' * (-len(token) % 4)), use_decimal=True)
+    except (TypeError, UnicodeError):
+        raise ValueError('Invalid continuation token')
+
+    if not isinstance(keys, list) or len(keys) != nkeys:
+        raise ValueError('Invalid continuation token')
+    return tuple(keys)
+
+_mimetypes = {
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson',
+    'columnar': 'application/vnd.moresql.columnar+json',
+    'csv': 'text/csv',
+    'msgpack': 'application/x-msgpack',
+}
+
+#: Output formats, by order of preference when negotiated
+_formats = [ 'json', 'ndjson', 'columnar', 'csv', 'msgpack' ]
+
+#: Output formats built out of plain tuples rather than dictionaries
+_tuple_formats = ('columnar', 'csv')
+
+def _columns(cursor):
+    return [ column[0] for column in cursor.description ]
+
+def _msgpack_default(obj):
+    if isinstance(obj, (datetime.datetime, datetime.date, datetime.time)):
+        return obj.isoformat()
+    if isinstance(obj, decimal.Decimal):
+        return float(obj)
+    if isinstance(obj, simplejson.RawJSON):
+        return simplejson.loads(obj.encoded_json)
+    raise TypeError("%r cannot be serialized" % obj)
+
+def _document_start(format, columns):
+    """Return the beginning of a `format` document, before any row."""
+    if format == 'json':
+        return '['
+    if format == 'columnar':
+        return '{"columns": %s, "rows": [' % simplejson.dumps(columns)
+    if format == 'csv':
+        return _dump_rows([ columns ], format)
+    return ''
+
+_document_ends = { 'json': ']', 'columnar': ']}' }
+
+def _compress(body, encoding, level=6):
+    """Compress the given body with the `gzip` or `deflate` content
+    coding."""
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(level, zlib.DEFLATED,
+                                      16 + zlib.MAX_WBITS)
+        return compressor.compress(body) + compressor.flush()
+    return zlib.compress(body, level)
+
+def _dump_rows(rows, format, first=True):
+    """Serialize a batch of rows as a fragment of a `format` document. Unless
+    `first` is true, the rows are assumed to follow an earlier batch."""
+    if format == 'ndjson':
+        return ''.join([ simplejson.dumps(row, default=dthandler) + '\n'
+            for row in rows ])
+
+    if format == 'csv':
+        out = cStringIO.StringIO()
+        writer = csv.writer(out)
+        for row in rows:
+            writer.writerow([ _csv_value(value) for value in row ])
+        return out.getvalue()
+
+    # Strip the enclosing brackets, the caller takes care of them
+    fragment = simplejson.dumps(rows, default=dthandler)[1:-1]
+    if first:
+        return fragment
+    return ',' + fragment
+
+_identifier_re = re.compile(r'^[A-Za-z_][\w$]*$')
+
+#: Name of the temporary table bulk loaded rows are staged into
+_staging_table = 'moresql_staging'
+
+def _csv_records(lines):
+    """Yield ``(line, row, error)`` tuples out of the given CSV lines. Empty
+    fields are read as NULL."""
+    reader = csv.reader(lines)
+    while True:
+        try:
+            row = next(reader)
+        except StopIteration:
+            return
+        except csv.Error as e:
+            yield reader.line_num, None, str(e)
+            continue
+
+        if row:
+            yield reader.line_num, [ value if value != '' else None
+                                     for value in row ], None
+
+def _csv_value(value):
+    """Convert a value to its CSV representation, as understood by COPY."""
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (dict, list)):
+        return simplejson.dumps(value)
+    if isinstance(value, simplejson.RawJSON):
+        return value.encoded_json
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+def _ndjson_records(lines, columns):
+    """Yield ``(line, row, error)`` tuples out of the given NDJSON lines,
+    taking the values of `columns` out of each object."""
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+
+        try:
+            obj = simplejson.loads(line)
+        except ValueError as e:
+            yield number, None, str(e)
+            continue
+
+        if not isinstance(obj, dict):
+            yield number, None, 'Expected a JSON object'
+            continue
+
+        yield number, [ _csv_value(obj.get(column))
+                        for column in columns ], None
+
+class _CopySource(object):
+    """A file-like object feeding ``COPY ... FROM STDIN`` with the given
+    records, one batch at a time. Records with errors, or with a number of
+    values other than `ncolumns`, are skipped and counted as rejected."""
+
+    max_errors = 100
+
+    def __init__(self, records, ncolumns):
+        self.records = records
+        self.ncolumns = ncolumns
+        self.accepted = 0
+        self.rejected = 0
+        self.errors = []
+
+    def reject(self, line, error):
+        self.rejected += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append({ 'line': line, 'error': error })
+
+    def read(self, size=8192):
+        out = cStringIO.StringIO()
+        writer = csv.writer(out)
+
+        while out.tell() < size:
+            try:
+                line, row, error = next(self.records)
+            except StopIteration:
+                break
+
+            if error is None and len(row) != self.ncolumns:
+                error = 'Expected %d values, got %d' % (self.ncolumns,
+                                                         len(row))
+            if error is not None:
+                self.reject(line, error)
+                continue
+
+            writer.writerow([ value if value is not None else '\\N'
+                              for value in row ])
+            self.accepted += 1
+
+        return out.getvalue()
+
+# Options of :meth:`MoreSQL.execute` a :class:`Procedure` is set up with,
+# and the configuration setting each of them defaults to
+_procedure_options = {
+    'stream': None,
+    'format': None,
+    'batch_size': None,
+    'cache': None,
+    'cache_ttl': 'MORESQL_CACHE_TTL',
+    'server_json': 'MORESQL_SERVER_JSON',
+    'transaction': 'MORESQL_TRANSACTION',
+    'prepare': 'MORESQL_PREPARE',
+    'etag': 'MORESQL_ETAG',
+    'cache_control': 'MORESQL_CACHE_CONTROL',
+    'compress': 'MORESQL_COMPRESS',
+    'page_by': None,
+    'timeout': 'MORESQL_TIMEOUT',
+    'coalesce': 'MORESQL_COALESCE',
+    'shard_key': None,
+    'scatter': None,
+    'max_rows': 'MORESQL_MAX_ROWS',
+    'max_bytes': 'MORESQL_MAX_BYTES',
+    'on_limit': 'MORESQL_ON_LIMIT',
+}
+
+#: Maximum number of :class:`Procedure` handles kept for execute() calls
+_max_handles = 1024
+
+# Settings of `MORESQL_PROCEDURES` which are not options of execute(),
+# resolved along with them
+_procedure_settings = {
+    'slow_call': 'MORESQL_SLOW_CALL',
+    'max_in_flight': 'MORESQL_MAX_IN_FLIGHT',
+}
+
+class Procedure(object):
+    """A stored procedure call, set up once and performed on behalf of many
+    requests, as returned by :meth:`MoreSQL.procedure`. Calling it with an
+    optional dictionary of values is the same as calling
+    :meth:`MoreSQL.execute` with its options.
+
+    Options are resolved against `MORESQL_PROCEDURES` and the configuration
+    on first call, and the SQL statement is built once per number of
+    arguments, so that each request only binds its arguments.
+    """
+
+    __slots__ = ('db', 'procname', 'fields', 'options', 'compiled',
+                 'statements') + tuple(_procedure_options) + \
+                tuple(_procedure_settings)
+
+    def __init__(self, db, procname, fields=None, **options):
+        if not _procname_re.match(procname):
+            raise RuntimeError("Invalid stored procedure name '%s'" % procname)
+        for name in options:
+            if name not in _procedure_options:
+                raise TypeError("Unexpected procedure option '%s'" % name)
+
+        self.db = db
+        self.procname = procname
+        self.fields = tuple(fields) if fields is not None else None
+        self.options = options
+        self.compiled = False
+        self.statements = {}
+
+    def compile(self):
+        """Resolve the options of the call."""
+        config = self.db.app.config
+        for name, setting in _procedure_options.items():
+            setattr(self, name, self.db._option(self.procname, name,
+                self.options.get(name), config.get(setting)))
+        for name, setting in _procedure_settings.items():
+            setattr(self, name, self.db._option(self.procname, name, None,
+                                                config[setting]))
+
+        if self.format is not None and self.format not in _mimetypes:
+            raise RuntimeError("Unsupported output format '%s'" % self.format)
+        if self.format == 'msgpack' and msgpack is None:
+            raise RuntimeError("The msgpack module is required to output "
+                               "MessagePack")
+        if self.on_limit not in ('error', 'truncate'):
+            raise RuntimeError("Unsupported limit behaviour '%s'" %
+                               self.on_limit)
+        self.compiled = True
+
+    def statement(self, nargs):
+        """Return the SQL statement performing the call with `nargs`
+        arguments."""
+        statement = self.statements.get(nargs)
+        if statement is None:
+            statement = self.statements[nargs] = \
+                _call_statement(self.procname, nargs)
+        return statement
+
+    def route(self, rule, **options):
+        """Register the procedure as the view of the given URL rule, as
+        :meth:`flask.Flask.route` does, and return it. URL variables are
+        taken as HTTP values::
+
+            db.procedure('get_dog', [ 'dog_id' ]).route('/dogs/<int:dog_id>')
+
+        The endpoint defaults to the name of the procedure.
+        """
+        options.setdefault('endpoint', self.procname)
+        self.db.app.add_url_rule(rule, view_func=self, **options)
+        return self
+
+    def __call__(self, values=None, **view_args):
+        return self.db._call(self, values, view_args)
+
 class MoreSQL(object):
     """Used to connect to a given PostgreSQL database.
 
@@ -97,23 +1474,774 @@ class MoreSQL(object):
 
         app = Flask(__name__)
         db = MoreSQL(app)
+
+    Applications created by a factory can be bound later on with
+    :meth:`init_app`::
+
+        db = MoreSQL()
+
+        def create_app():
+            app = Flask(__name__)
+            db.init_app(app)
+            return app
+
+    Connections are kept in a :class:`ConnectionPool`, which is only created
+    the first time the database is used, and created again in processes
+    forked afterwards. Each application context checks out its own
+    connection the first time the database is used, and returns it to the
+    pool on teardown.
     """
     
-    def __init__(self, app):
+    _cursor_names = itertools.count()
+
+    def __init__(self, app=None):
+        self.app = None
+
+        self._pid = None
+        self._pool = None
+        self._replicas = []
+        self._shards = {}
+        self._pools_lock = threading.Lock()
+        self._next_replica = itertools.count()
+        # Replica pools mapped to the time until which they are not used
+        self._replicas_down = {}
+
+        self._signatures = {}
+        self._signatures_lock = threading.Lock()
+        self._handles = {}
+
+        self.cache = None
+        self.metrics = None
+
+        self._listener = None
+        self._listener_conn = None
+        self._listener_lock = threading.Lock()
+        self._listening = threading.Event()
+
+        self._watchdog = _Watchdog()
+        self._in_flight = {}
+        self._in_flight_lock = threading.Lock()
+
+        self.coalescer = Coalescer()
+        self._explain_lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Bind MoreSQL to the given application. No connection is opened
+        until the database is first used."""
         self.app = app
 
-        creds = parse_rfc1738_args(app.config.get('MORESQL_DATABASE_URI'))
-        
-        self.connection = psycopg2.connect(user=creds['username'], 
-                                           password=creds['password'], 
-                                           dbname=creds['database'], 
-                                           host=creds['host'], 
-                                           port=creds['port'])
+        app.config.setdefault('MORESQL_STREAM_BATCH_SIZE', 1000)
+        app.config.setdefault('MORESQL_INTROSPECTION', True)
+        app.config.setdefault('MORESQL_SIGNATURE_TTL', None)
+        app.config.setdefault('MORESQL_PROCEDURES', {})
+        app.config.setdefault('MORESQL_SERVER_JSON', False)
+        app.config.setdefault('MORESQL_TRANSACTION', None)
+        app.config.setdefault('MORESQL_PREPARE', False)
+        app.config.setdefault('MORESQL_PREPARED_MAX', 100)
+        app.config.setdefault('MORESQL_TYPECASTS', True)
+        app.config.setdefault('MORESQL_NUMERIC', 'decimal')
+        app.config.setdefault('MORESQL_PAGE_SIZE', 100)
+        app.config.setdefault('MORESQL_PAGE_MAX_SIZE', 1000)
+        app.config.setdefault('MORESQL_TIMEOUT', None)
+        app.config.setdefault('MORESQL_MAX_IN_FLIGHT', None)
+        app.config.setdefault('MORESQL_RETRY_AFTER', 1)
+        app.config.setdefault('MORESQL_COALESCE', False)
+        app.config.setdefault('MORESQL_MAX_ROWS', None)
+        app.config.setdefault('MORESQL_MAX_BYTES', None)
+        app.config.setdefault('MORESQL_ON_LIMIT', 'error')
+        app.config.setdefault('MORESQL_METRICS', False)
+        app.config.setdefault('MORESQL_METRICS_ENDPOINT', None)
+        app.config.setdefault('MORESQL_SLOW_CALL', None)
+        app.config.setdefault('MORESQL_SLOW_REDACT', [])
+        app.config.setdefault('MORESQL_SLOW_EXPLAIN_RATE', 0)
+        app.config.setdefault('MORESQL_CACHE', False)
+        app.config.setdefault('MORESQL_CACHE_SIZE', 1024)
+        app.config.setdefault('MORESQL_CACHE_TTL', 60)
+        app.config.setdefault('MORESQL_CACHE_CHANNEL', 'moresql_invalidate')
+        app.config.setdefault('MORESQL_ETAG', False)
+        app.config.setdefault('MORESQL_CACHE_CONTROL', None)
+        app.config.setdefault('MORESQL_COMPRESS', False)
+        app.config.setdefault('MORESQL_COMPRESS_MIN_SIZE', 1024)
+        app.config.setdefault('MORESQL_COMPRESS_LEVEL', 6)
+        app.config.setdefault('MORESQL_POOL_MIN_SIZE', 1)
+        app.config.setdefault('MORESQL_POOL_MAX_SIZE', 10)
+        app.config.setdefault('MORESQL_POOL_TIMEOUT', 30)
+        app.config.setdefault('MORESQL_POOL_PRE_PING', False)
+        app.config.setdefault('MORESQL_POOL_BACKOFF', 0.1)
+        app.config.setdefault('MORESQL_WAIT_CALLBACK', None)
+        app.config.setdefault('MORESQL_REPLICA_URIS', [])
+        app.config.setdefault('MORESQL_REPLICA_BALANCING', 'round_robin')
+        app.config.setdefault('MORESQL_READ_YOUR_WRITES', False)
+        app.config.setdefault('MORESQL_REPLICA_COOLOFF', 10)
+        app.config.setdefault('MORESQL_SHARD_URIS', {})
+        app.config.setdefault('MORESQL_SHARDING', 'hash')
+        app.config.setdefault('MORESQL_SHARD_RANGES', [])
+
+        # Credentials are checked upfront, connections are opened lazily
+        self._creds = parse_rfc1738_args(
+            app.config.get('MORESQL_DATABASE_URI'))
+        self._replica_creds = [ parse_rfc1738_args(uri)
+            for uri in app.config['MORESQL_REPLICA_URIS'] ]
+        self._shard_creds = dict((name, parse_rfc1738_args(uri))
+            for name, uri in app.config['MORESQL_SHARD_URIS'].items())
+
+        sharding = app.config['MORESQL_SHARDING']
+        if not callable(sharding) and sharding not in ('hash', 'range'):
+            raise RuntimeError("Unsupported sharding '%s'" % sharding)
+        ranges = app.config['MORESQL_SHARD_RANGES']
+        self._shard_bounds = [ bound for bound, name in ranges ]
+        self._shard_names = [ name for bound, name in ranges ]
+        if self._shard_bounds != sorted(self._shard_bounds):
+            raise RuntimeError("Shard ranges must be sorted by lower bound")
+        for name in self._shard_names:
+            if name not in self._shard_creds:
+                raise RuntimeError("Unknown shard '%s'" % name)
+
+        if app.config['MORESQL_REPLICA_BALANCING'] not in \
+                ('round_robin', 'least_outstanding'):
+            raise RuntimeError("Unsupported replica balancing '%s'" %
+                app.config['MORESQL_REPLICA_BALANCING'])
+
+        wait = app.config['MORESQL_WAIT_CALLBACK']
+        if wait is not None:
+            if wait == 'gevent' and gevent is None:
+                raise RuntimeError("The gevent module is required to wait "
+                                   "for queries in greenlets")
+            if not callable(wait):
+                if wait not in _wait_callbacks:
+                    raise RuntimeError("Unsupported wait callback '%s'" % wait)
+                wait = _wait_callbacks[wait]
+            # psycopg2 only has one wait callback, shared by all connections
+            psycopg2.extensions.set_wait_callback(wait)
+
+        self._typecasters = []
+        if app.config['MORESQL_TYPECASTS']:
+            self._typecasters = _typecasters(app.config['MORESQL_NUMERIC'])
+
+        self.cache = ResultCache(app.config['MORESQL_CACHE_SIZE'])
+
+        if app.config['MORESQL_METRICS']:
+            self.metrics = Metrics()
+            if app.config['MORESQL_METRICS_ENDPOINT'] is not None:
+                app.add_url_rule(app.config['MORESQL_METRICS_ENDPOINT'],
+                                 'moresql_metrics', self._metrics_view)
+
+        app.extensions = getattr(app, 'extensions', {})
+        app.extensions['moresql'] = self
+
+        app.register_error_handler(PoolTimeout, self._unavailable)
+        app.register_error_handler(Overloaded, self._unavailable)
+        app.register_error_handler(CallTimeout, self._timed_out)
+        app.register_error_handler(ResultTooLarge, self._too_large)
+
+        if hasattr(app, 'teardown_appcontext'):
+            app.teardown_appcontext(self.teardown)
+        else:
+            app.teardown_request(self.teardown)
+
+    def connect(self, creds):
+        """Open a new database connection with the given credentials, as
+        returned by :func:`parse_rfc1738_args`. Subclasses can override this
+        method to customize connections."""
+        return psycopg2.connect(user=creds['username'], 
+                                password=creds['password'], 
+                                dbname=creds['database'], 
+                                host=creds['host'], 
+                                port=creds['port'],
+                                connection_factory=_Connection)
+
+    def _make_pool(self, creds, minconn=None, backoff=None):
+        """Return a connection pool to the database with the given
+        credentials, opening `minconn` connections upfront,
+        `MORESQL_POOL_MIN_SIZE` by default, and retrying connections after
+        `backoff` seconds, `MORESQL_POOL_BACKOFF` by default."""
+        def connect():
+            return self.connect(creds)
+
+        if minconn is None:
+            minconn = self.app.config['MORESQL_POOL_MIN_SIZE']
+        if backoff is None:
+            backoff = self.app.config['MORESQL_POOL_BACKOFF']
+
+        return ConnectionPool(connect, minconn=minconn,
+            maxconn=self.app.config['MORESQL_POOL_MAX_SIZE'],
+            timeout=self.app.config['MORESQL_POOL_TIMEOUT'],
+            pre_ping=self.app.config['MORESQL_POOL_PRE_PING'],
+            backoff=backoff)
+
+    def _ensure_pools(self):
+        """Create the connection pools of the current process, if not done
+        yet."""
+        if self._pid == os.getpid():
+            return
+
+        if self.app is None:
+            raise RuntimeError("MoreSQL is not bound to any application")
+
+        with self._pools_lock:
+            pid = os.getpid()
+            if self._pid == pid:
+                return
 
-        self.cursor = self.connection.cursor(
+            if self._pid is not None:
+                # Forked: the connections and the listener thread of the
+                # parent are not ours. Closing those connections (or, with
+                # older psycopg2 versions, letting them be garbage collected)
+                # would terminate the sessions of the parent, so they are
+                # kept around untouched.
+                _inherited.append((self._pool, self._replicas, self._shards,
+                                   self._listener_conn))
+                self._listener = None
+                self._listener_conn = None
+                self._listening = threading.Event()
+                self._watchdog = _Watchdog()
+                self._in_flight = {}
+                self.coalescer = Coalescer()
+                self._explain_lock = threading.Lock()
+                self._replicas_down = {}
+
+            self._pool = self._make_pool(self._creds)
+
+            # Replicas and shards are connected to on demand, so that an
+            # unavailable one only fails the calls it has to serve. Reads
+            # fall back to the primary rather than wait for a replica to
+            # come back.
+            self._replicas = [ self._make_pool(creds, 0, 0)
+                for creds in self._replica_creds ]
+            self._shards = dict((name, self._make_pool(creds, 0))
+                for name, creds in self._shard_creds.items())
+            self._pid = pid
+
+    @property
+    def pool(self):
+        """The :class:`ConnectionPool` of the primary database, in the
+        current process."""
+        self._ensure_pools()
+        return self._pool
+
+    @property
+    def replicas(self):
+        """The connection pools of the read replicas, in the current
+        process."""
+        self._ensure_pools()
+        return self._replicas
+
+    @property
+    def shards(self):
+        """A dictionary mapping shard names to their connection pools, in
+        the current process."""
+        self._ensure_pools()
+        return self._shards
+
+    def shard(self, key):
+        """Return the name of the shard holding the rows of the given shard
+        key, as routed by `MORESQL_SHARDING`."""
+        names = sorted(self._shard_creds)
+        if not names:
+            raise RuntimeError("No shards configured")
+
+        sharding = self.app.config['MORESQL_SHARDING']
+        if callable(sharding):
+            return sharding(key)
+
+        if sharding == 'hash':
+            # Unlike hash(), stable across processes and Python versions
+            digest = zlib.crc32(unicode(key).encode('utf-8')) & 0xffffffff
+            return names[digest % len(names)]
+
+        if isinstance(key, basestring):
+            key = _convert_http_value(key)
+        pos = bisect.bisect_right(self._shard_bounds, key) - 1
+        if pos < 0:
+            raise ValueError("No shard for key %r" % (key,))
+        return self._shard_names[pos]
+
+    def warm_up(self, count=None):
+        """Open at least `count` connections to the primary database and to
+        each replica and shard, `MORESQL_POOL_MIN_SIZE` by default. Meant to
+        be called by each worker process of pre-fork servers before serving
+        requests. Unavailable replicas are logged and skipped, as read-only
+        calls fall back to the primary database."""
+        if count is None:
+            count = self.app.config['MORESQL_POOL_MIN_SIZE']
+
+        for pool in [ self.pool ] + self.shards.values():
+            pool.warm_up(count)
+
+        for replica in self.replicas:
+            try:
+                replica.warm_up(count)
+            except psycopg2.OperationalError:
+                self.app.logger.exception("Replica unavailable")
+
+    def _checkout(self, pool, timeout=None):
+        """Return the connection of the given pool bound to the current
+        application context, checking it out on first access. Wait at most
+        `timeout` seconds for a connection, if less than the pool
+        timeout."""
+        ctx = stack.top
+        if ctx is None:
+            raise RuntimeError("MoreSQL used outside of application context")
+
+        conns = getattr(ctx, 'moresql_connections', None)
+        if conns is None:
+            conns = ctx.moresql_connections = {}
+
+        conn = conns.get(pool)
+        if conn is None:
+            if timeout is not None:
+                timeout = min(timeout, pool.timeout)
+            conn = conns[pool] = pool.getconn(timeout)
+
+        return conn
+
+    @property
+    def connection(self):
+        """The connection to the primary database bound to the current
+        application context. It is checked out of the pool on first
+        access.
+
+        Session state left by stored procedure calls, such as read-only
+        sessions in autocommit mode, is kept across calls and requests to
+        save round trips, and reset here whenever no transaction is in
+        progress."""
+        conn = self._checkout(self.pool)
+        if conn.get_transaction_status() == \
+                psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            conn.restore()
+        return conn
+
+    def _route(self, mode, timeout=None):
+        """Return the connection the current call should run on, given its
+        transaction mode. Read-only calls go to the replica chosen for the
+        current context, unless they are part of an explicit transaction or
+        follow a write in read-your-writes mode."""
+        if not self.replicas:
+            return self._checkout(self.pool, timeout)
+
+        ctx = stack.top
+        if mode != 'readonly':
+            if self.app.config['MORESQL_READ_YOUR_WRITES']:
+                ctx.moresql_wrote = True
+            return self._checkout(self.pool, timeout)
+
+        if getattr(ctx, 'moresql_transaction', False) \
+                or getattr(ctx, 'moresql_wrote', False):
+            return self._checkout(self.pool, timeout)
+
+        replica = getattr(ctx, 'moresql_replica', None)
+        if replica is None:
+            now = time.time()
+            replicas = [ pool for pool in self.replicas
+                         if self._replicas_down.get(pool, 0) <= now ]
+            if not replicas:
+                return self._checkout(self.pool, timeout)
+
+            if self.app.config['MORESQL_REPLICA_BALANCING'] == 'round_robin':
+                pos = next(self._next_replica) % len(replicas)
+                replica = replicas[pos]
+            else:
+                replica = min(replicas, key=lambda pool: pool.in_use)
+
+        try:
+            conn = self._checkout(replica, timeout)
+        except psycopg2.OperationalError:
+            # Leave the replica alone for a while
+            self._replicas_down[replica] = time.time() + \
+                self.app.config['MORESQL_REPLICA_COOLOFF']
+            self.app.logger.exception("Replica unavailable, using primary")
+            return self._checkout(self.pool, timeout)
+
+        ctx.moresql_replica = replica
+        return conn
+
+    def _pool_of(self, connection):
+        """Return the pool the given connection of the current context was
+        checked out of."""
+        for pool, conn in stack.top.moresql_connections.items():
+            if conn is connection:
+                return pool
+
+    @property
+    def cursor(self):
+        """A new dictionary cursor on the current context connection."""
+        return self.connection.cursor(
             cursor_factory=psycopg2.extras.RealDictCursor)
 
-    def execute(self, procname, fields=None, values=None):
+    def teardown(self, exception):
+        """Return the connections of the current context to their pools."""
+        ctx = stack.top
+        conns = getattr(ctx, 'moresql_connections', None)
+        if conns:
+            ctx.moresql_connections = {}
+            for pool, conn in conns.items():
+                pool.putconn(conn)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Run all the stored procedures called within the block in a single
+        transaction. The transaction is committed at the end of the block, or
+        rolled back if an exception is raised::
+
+            with db.transaction():
+                db.execute('update_dog', fields=[ 'dog_id', 'name' ])
+                return db.execute('get_dog', fields=[ 'dog_id' ])
+
+        Nested blocks are part of the outermost transaction.
+        """
+        ctx = stack.top
+        if getattr(ctx, 'moresql_transaction', False):
+            yield
+            return
+
+        conn = self._checkout(self.pool)
+        self._begin(conn, 'commit')
+
+        ctx.moresql_transaction = True
+        try:
+            yield
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+        finally:
+            ctx.moresql_transaction = False
+
+    def _begin(self, conn, mode, autocommit=None, timeout=None):
+        """Prepare the connection to run a call in the given transaction
+        mode, with the given statement timeout, unless an explicit
+        transaction is in progress. Return True if the call has to be
+        committed."""
+        statement_timeout = None
+        if timeout is not None:
+            statement_timeout = '%dms' % max(1, timeout * 1000)
+
+        if getattr(stack.top, 'moresql_transaction', False):
+            # The timeout lasts until the end of the transaction
+            if statement_timeout is not None:
+                conn.cursor().execute('SET LOCAL statement_timeout = %s',
+                                      (statement_timeout,))
+            return False
+
+        try:
+            readonly, mode_autocommit = _transaction_modes[mode]
+        except KeyError:
+            raise RuntimeError("Unsupported transaction mode '%s'" % mode)
+
+        if autocommit is None:
+            autocommit = mode_autocommit
+
+        settings = conn.settings
+        if conn.autocommit == autocommit and \
+                settings['default_transaction_read_only'] == readonly and \
+                settings.get('statement_timeout') == statement_timeout:
+            return not autocommit
+
+        if conn.get_transaction_status() != \
+                psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            # Commit pending work before switching mode, as a call in
+            # commit mode would have done
+            conn.commit()
+
+        conn.autocommit = True
+        conn.configure({ 'default_transaction_read_only': readonly,
+                         'statement_timeout': statement_timeout })
+        conn.autocommit = autocommit
+
+        return not autocommit
+
+    def _transaction_mode(self, signature, transaction):
+        """Return the transaction mode of a call, given the signature it
+        matched and its `transaction` option, as resolved for the
+        procedure."""
+        if transaction is not None:
+            return transaction
+
+        # Procedures that cannot modify the database need no commit
+        if signature is not None and signature.volatility != 'volatile':
+            return 'readonly'
+
+        return 'commit'
+
+    def _timer(self, procname, slow=None):
+        """Return the timer of a call, logged if it takes more than `slow`
+        seconds."""
+        if self.metrics is None and slow is None:
+            return _null_timer
+        return _Timer(self.app, self.metrics, procname, slow, self._log_slow)
+
+    def _log_slow(self, timer, error=None):
+        """Log the given slow call, and have a sample of them explained."""
+        procname = timer.procname
+        record = {
+            'procname': procname,
+            'timings': timer.timings,
+            'rows': timer.rows,
+            'size': timer.size,
+            'error': str(error) if error is not None else None,
+        }
+
+        if timer.arguments is not None:
+            names, procargs = timer.arguments
+            redact = self._option(procname, 'redact', None,
+                                  self.app.config['MORESQL_SLOW_REDACT'])
+            if redact is True:
+                procargs = [ _redacted ] * len(procargs)
+            elif len(names) == len(procargs):
+                procargs = [ _redacted if name in redact else value
+                             for name, value in zip(names, procargs) ]
+            elif redact:
+                procargs = [ _redacted ] * len(procargs)
+            record['arguments'] = procargs
+
+        self.app.logger.warning("Slow call to %s: %s", procname,
+            simplejson.dumps(record, default=dthandler, sort_keys=True))
+
+        # Explaining runs the call again, which is only safe without writes,
+        # on the database it ran on: scattered calls ran on several of them
+        rate = self.app.config['MORESQL_SLOW_EXPLAIN_RATE']
+        if timer.mode == 'readonly' and timer.pool is not None \
+                and random.random() < rate \
+                and self._explain_lock.acquire(False):
+            thread = threading.Thread(target=self._explain_slow,
+                args=(procname, timer.statement, timer.arguments[1],
+                      timer.pool))
+            thread.daemon = True
+            thread.start()
+
+    def _explain_slow(self, procname, statement, procargs, pool):
+        """Log the plans of the given call, run again on a diagnostic
+        connection of its own to the database of the given pool."""
+        try:
+            conn = pool.connect()
+            try:
+                plans = _explain(conn, statement, procargs)
+            finally:
+                conn.close()
+            self.app.logger.warning("Plans of slow call to %s:\n%s",
+                                    procname, '\n'.join(plans))
+        except psycopg2.Error:
+            self.app.logger.exception("Could not explain slow call to %s" %
+                                      procname)
+        finally:
+            self._explain_lock.release()
+
+    def _unavailable(self, error):
+        response = make_response('Service Unavailable', 503)
+        response.headers['Retry-After'] = \
+            str(self.app.config['MORESQL_RETRY_AFTER'])
+        return response
+
+    def _timed_out(self, error):
+        return make_response('Gateway Timeout', 504)
+
+    def _too_large(self, error):
+        return make_response(str(error), 422)
+
+    def _acquire_slot(self, procname, limit):
+        """Reserve one of the `limit` in-flight call slots of the given
+        procedure. Return the semaphore to release when the call is over, or
+        None if the procedure has no limit. Raise :class:`Overloaded` if all
+        the slots are taken."""
+        if limit is None:
+            return None
+
+        semaphore = self._in_flight.get(procname)
+        if semaphore is None:
+            with self._in_flight_lock:
+                semaphore = self._in_flight.setdefault(procname,
+                    threading.BoundedSemaphore(limit))
+
+        if not semaphore.acquire(False):
+            raise Overloaded("Too many calls to %s in flight" % procname)
+        return semaphore
+
+    def _metrics_view(self):
+        response = make_response(self.metrics.prometheus())
+        response.mimetype = 'text/plain'
+        response.headers['Content-Type'] += '; version=0.0.4'
+        return response
+
+    def _option(self, procname, name, value=None, default=None):
+        """Return the value of an :meth:`execute` option: `value` if given,
+        otherwise the one configured for the procedure in
+        `MORESQL_PROCEDURES`, otherwise `default`."""
+        if value is not None:
+            return value
+
+        options = self.app.config['MORESQL_PROCEDURES'].get(procname)
+        if options is not None and options.get(name) is not None:
+            return options[name]
+
+        return default
+
+    def _listen(self, channel):
+        """Evict cached results as notifications are received on the given
+        channel. The payload is a comma-separated list of procedure names, or
+        empty to evict everything."""
+        while True:
+            conn = None
+            try:
+                conn = self._listener_conn = self.pool.connect()
+                conn.autocommit = True
+                conn.cursor().execute('LISTEN %s' % channel)
+
+                # Anything may have changed while we were not listening
+                self.cache.invalidate()
+                self._listening.set()
+
+                while True:
+                    if select.select([ conn ], [], [], 5) == ([], [], []):
+                        continue
+
+                    conn.poll()
+                    while conn.notifies:
+                        payload = conn.notifies.pop(0).payload
+                        if not payload:
+                            self.cache.invalidate()
+                            continue
+                        for procname in payload.split(','):
+                            self.cache.invalidate(procname.strip())
+            except psycopg2.Error:
+                self.app.logger.exception("Cache invalidation listener failed")
+                self.cache.invalidate()
+                # Do not keep callers waiting for the listener to recover
+                self._listening.set()
+                if conn is not None and not conn.closed:
+                    conn.close()
+                time.sleep(1)
+
+    def _start_listener(self):
+        """Start the invalidation listener if not done yet, and wait for it
+        to listen: results cached earlier would be evicted as it starts, and
+        could miss notifications."""
+        channel = self.app.config['MORESQL_CACHE_CHANNEL']
+        if channel is None or self._listening.is_set():
+            return
+
+        if not re.match(r'^[A-Za-z_]\w*$', channel):
+            raise RuntimeError("Invalid notification channel '%s'" % channel)
+
+        with self._listener_lock:
+            if self._listener is None:
+                self._listener = threading.Thread(target=self._listen,
+                                                  args=(channel,))
+                self._listener.daemon = True
+                self._listener.start()
+
+        self._listening.wait(self.app.config['MORESQL_POOL_TIMEOUT'])
+
+    def _cacheable(self, signature, cache):
+        """Return True if the results of a call should be cached, given the
+        signature it matched and its `cache` option, as resolved for the
+        procedure."""
+        if cache is not None:
+            return cache
+
+        # By default, only cache procedures known not to modify the database
+        return self.app.config['MORESQL_CACHE'] and signature is not None \
+            and signature.volatility != 'volatile'
+
+    def signatures(self, procname):
+        """Return the list of :class:`ProcedureSignature` objects of the
+        stored procedures called `procname`, one per overload.
+
+        Signatures are read from pg_catalog the first time a procedure is
+        used, and cached for `MORESQL_SIGNATURE_TTL` seconds (forever by
+        default). An empty list is returned if introspection has been
+        disabled with `MORESQL_INTROSPECTION`.
+        """
+        if not self.app.config['MORESQL_INTROSPECTION']:
+            return []
+
+        entry = self._signatures.get(procname)
+        ttl = self.app.config['MORESQL_SIGNATURE_TTL']
+
+        if entry is None or (ttl is not None and entry[0] + ttl < time.time()):
+            entry = (time.time(), self._load_signatures(procname))
+            with self._signatures_lock:
+                self._signatures[procname] = entry
+
+        return entry[1]
+
+    def refresh_signatures(self, procname=None):
+        """Forget the cached signatures of the given stored procedure, or of
+        all of them. They are read again on next use."""
+        with self._signatures_lock:
+            if procname is None:
+                self._signatures.clear()
+            else:
+                self._signatures.pop(procname, None)
+
+    def _load_signatures(self, procname):
+        if not _procname_re.match(procname):
+            raise RuntimeError("Invalid stored procedure name '%s'" % procname)
+
+        if '.' in procname:
+            schema, name = procname.split('.')
+            visible = 'n.nspname = %(schema)s'
+        else:
+            schema, name = None, procname
+            visible = 'pg_catalog.pg_function_is_visible(p.oid)'
+
+        conn = self._checkout(self.pool)
+        idle = conn.get_transaction_status() == \
+            psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT p.proargnames, p.proargmodes::text[],
+                coalesce(p.proallargtypes, p.proargtypes::oid[])::int8[],
+                p.prorettype::int8, p.proretset, p.provolatile::text,
+                p.pronargdefaults
+            FROM pg_catalog.pg_proc p
+            JOIN pg_catalog.pg_namespace n ON n.oid = p.pronamespace
+            WHERE p.proname = %(name)s AND """ + visible,
+            { 'name': name, 'schema': schema })
+        procs = cursor.fetchall()
+
+        oids = set()
+        for proc in procs:
+            oids.update(proc[2])
+            oids.add(proc[3])
+
+        types = {}
+        if oids:
+            cursor.execute("""
+                SELECT oid::int8, typname, typcategory::text
+                FROM pg_catalog.pg_type WHERE oid = ANY(%s::oid[])""",
+                (list(oids),))
+            types = dict((row[0], row[1:]) for row in cursor.fetchall())
+
+        cursor.close()
+        if idle and not conn.autocommit:
+            # Do not leave a transaction open on behalf of the caller
+            conn.rollback()
+
+        signatures = []
+        for names, modes, argtypes, rettype, retset, volatility, ndefaults \
+                in procs:
+            arguments = []
+            for pos, oid in enumerate(argtypes):
+                typname, category = types.get(oid, (None, None))
+                arguments.append(Argument(names[pos] if names else None,
+                    typname, category, modes[pos] if modes else 'i'))
+
+            signatures.append(ProcedureSignature(procname, arguments,
+                types.get(rettype, (None,))[0], retset, volatility, ndefaults))
+
+        return signatures
+
+    def execute(self, procname, fields=None, values=None, stream=False,
+                format=None, batch_size=None, cache=None, cache_ttl=None,
+                server_json=None, transaction=None, prepare=None,
+                etag=None, cache_control=None, compress=None,
+                page_by=None, limit=None, after=None, timeout=None,
+                coalesce=None, shard_key=None, scatter=None, max_rows=None,
+                max_bytes=None, on_limit=None):
         """Execute the given stored procedure. Return results as a JSON
         HTTP response.
         
@@ -124,22 +2252,949 @@ class MoreSQL(object):
         :param values: an optional dictionary of values from which the
                        parameters should be taken. If omitted, default to the 
                        values passed via HTTP
+        :param stream: if true, rows are fetched in batches through a
+                       server-side cursor and sent to the client as they
+                       arrive. The response is always a list of rows
+        :param format: ``'json'``, ``'ndjson'`` (one JSON document per row
+                       and per line), ``'columnar'`` (a JSON object holding
+                       the list of column names and a list of rows, each a
+                       list of values), ``'csv'`` (with a header line) or
+                       ``'msgpack'`` (shaped as JSON, and requiring the
+                       `msgpack` module). Only JSON and MessagePack
+                       responses are unwrapped to a single row or value.
+                       Defaults to the format preferred by the `Accept`
+                       header of the request, and to ``'json'``
+        :param batch_size: the number of rows fetched at a time when
+                           streaming. Defaults to `MORESQL_STREAM_BATCH_SIZE`
+        :param cache: whether to serve the response out of the result cache,
+                      overriding `MORESQL_PROCEDURES` and `MORESQL_CACHE`
+        :param cache_ttl: the number of seconds results are cached for.
+                          Defaults to `MORESQL_CACHE_TTL`
+        :param server_json: if true, results are serialized by PostgreSQL and
+                            sent to the client without being decoded.
+                            Defaults to `MORESQL_SERVER_JSON`
+        :param transaction: ``'commit'`` to call the procedure in a
+                            transaction and commit it, ``'autocommit'`` to
+                            call it without any explicit transaction and
+                            ``'readonly'`` to call it in autocommit mode in a
+                            read-only session. Defaults to
+                            `MORESQL_TRANSACTION` if set, and otherwise to
+                            ``'readonly'`` for `STABLE` and `IMMUTABLE`
+                            procedures and ``'commit'`` for the others.
+                            Ignored within :meth:`transaction` blocks
+        :param prepare: if true, the procedure is called through a
+                        server-side prepared statement, saving the parsing
+                        and planning costs on subsequent calls. Defaults to
+                        `MORESQL_PREPARE`. Streamed calls are never prepared
+        :param etag: if true, the response carries an `ETag` computed from
+                     its body, and requests whose `If-None-Match` header
+                     matches it get an empty ``304 Not Modified`` response.
+                     Defaults to `MORESQL_ETAG`
+        :param cache_control: the value of the `Cache-Control` header of the
+                              response, such as ``'private, max-age=60'``.
+                              Defaults to `MORESQL_CACHE_CONTROL`
+        :param compress: if true, bodies larger than
+                         `MORESQL_COMPRESS_MIN_SIZE` bytes are compressed
+                         with `gzip` or `deflate`, as accepted by the client.
+                         Defaults to `MORESQL_COMPRESS`. Streamed responses
+                         are neither tagged nor compressed
+        :param page_by: the name of a column, or a list of columns, which
+                        uniquely identify and order the rows returned by the
+                        procedure. Prefix all of them with ``-`` to sort in
+                        descending order. If given, rows are returned one
+                        page at a time, as a ``{"rows": [...], "next":
+                        token}`` object where `token` is ``null`` on the
+                        last page
+        :param limit: the number of rows per page. Defaults to the ``limit``
+                      request value, up to `MORESQL_PAGE_MAX_SIZE`, and
+                      otherwise to `MORESQL_PAGE_SIZE`
+        :param after: the `next` token of the previous page. Defaults to the
+                      ``after`` request value
+        :param timeout: the number of seconds after which the call is
+                        cancelled and answered with ``504 Gateway Timeout``,
+                        also bounding the wait for a pooled connection.
+                        Defaults to `MORESQL_TIMEOUT`
+        :param coalesce: if true, concurrent read-only calls with the same
+                         arguments wait for a single one of them to complete
+                         and share its result. Defaults to `MORESQL_COALESCE`.
+                         Calls within :meth:`transaction` blocks are never
+                         coalesced
+        :param shard_key: the field whose value tells which shard of
+                          `MORESQL_SHARD_URIS` the procedure is called on.
+                          Calls with neither a shard key nor `scatter` go to
+                          the primary database
+        :param scatter: if true, the procedure is called on all the shards
+                        in parallel, and the rows they return are sent as a
+                        single result. Scatter-gather calls can neither be
+                        streamed nor paginated
+        :param max_rows: the maximum number of rows of the result. Defaults
+                         to `MORESQL_MAX_ROWS`
+        :param max_bytes: the maximum size of the serialized result, in
+                          bytes. Defaults to `MORESQL_MAX_BYTES`. If set,
+                          rows are fetched in batches through a server-side
+                          cursor, which is closed as soon as a limit is
+                          exceeded
+        :param on_limit: ``'error'`` to answer calls exceeding a limit with
+                         ``422 Unprocessable Entity``, or ``'truncate'`` to
+                         send the rows within the limits, with an
+                         ``X-MoreSQL-Truncated: true`` header. Defaults to
+                         `MORESQL_ON_LIMIT`
         """
-        procargs = _get_procedure_arguments(fields, values)
+        if fields is not None:
+            fields = tuple(fields)
+        if isinstance(page_by, list):
+            page_by = tuple(page_by)
+
+        # Calls with the same options share a handle, and thus resolve them
+        # once
+        key = (procname, fields, stream, format, batch_size, cache,
+               cache_ttl, server_json, transaction, prepare, etag,
+               cache_control, compress, page_by, timeout, coalesce,
+               shard_key, scatter, max_rows, max_bytes, on_limit)
+        handle = self._handles.get(key)
+        if handle is None:
+            handle = Procedure(self, procname, fields, stream=stream,
+                format=format, batch_size=batch_size, cache=cache,
+                cache_ttl=cache_ttl, server_json=server_json,
+                transaction=transaction, prepare=prepare, etag=etag,
+                cache_control=cache_control, compress=compress,
+                page_by=page_by, timeout=timeout, coalesce=coalesce,
+                shard_key=shard_key, scatter=scatter, max_rows=max_rows,
+                max_bytes=max_bytes, on_limit=on_limit)
+            if len(self._handles) >= _max_handles:
+                self._handles.clear()
+            self._handles[key] = handle
 
-        result = self.cursor.callproc(procname, procargs)
+        return self._call(handle, values, limit=limit, after=after)
 
-        self.connection.commit()
+    def procedure(self, procname, fields=None, **options):
+        """Return a :class:`Procedure` calling the given stored procedure
+        with the given `fields`, and any other :meth:`execute` option but
+        `values`, `limit` and `after`::
 
-        if procargs == result:
-            # The parameters have not been modified. There was no in/out
-            # parameter, we have to fetch returned results from the cursor.
-            result = self.cursor.fetchall()
+            get_dog = db.procedure('get_dog', [ 'dog_id' ], compress=True)
 
-        if len(result) == 1:
-            if len(result[0]) == 1:
-                result = result[0].values()[0]
+            @app.route('/dog')
+            def dog():
+                return get_dog()
+        """
+        return Procedure(self, procname, fields, **options)
+
+    def _call(self, handle, values=None, view_args=None, limit=None,
+              after=None):
+        """Perform the given :class:`Procedure` call and return its
+        response."""
+        if not handle.compiled:
+            handle.compile()
+        procname = handle.procname
+
+        with self._timer(procname, handle.slow_call) as timer:
+            format = handle.format
+            negotiated = format is None
+            if negotiated:
+                format = self._negotiate_format(handle.page_by is not None,
+                                                handle.stream)
+
+            try:
+                procargs, signature = _get_procedure_arguments(handle.fields,
+                    values, self.signatures(procname), view_args)
+            except ValueError as e:
+                abort(400, str(e))
+
+            mode = self._transaction_mode(signature, handle.transaction)
+            timeout = handle.timeout
+            call = handle.statement(len(procargs))
+
+            shard = shard_name = None
+            if handle.shard_key is not None or handle.scatter:
+                if getattr(stack.top, 'moresql_transaction', False):
+                    raise RuntimeError("Sharded calls cannot be part of "
+                                       "transaction blocks")
+                if handle.scatter:
+                    if handle.stream or handle.page_by is not None:
+                        raise RuntimeError("Scatter-gather calls can neither "
+                                           "be streamed nor paginated")
+                else:
+                    shard_name, shard = self._shard_pool(handle.shard_key,
+                                                         values, view_args)
+
+            if timer.slow is not None:
+                timer.describe(_argument_names(handle.fields, values,
+                    view_args), procargs, mode, call)
+            timer.mark('bind')
+
+            page = None
+            if handle.page_by is not None:
+                if handle.stream or format != 'json':
+                    raise RuntimeError("Paginated calls can only return "
+                                       "JSON documents")
+                page = self._page(handle.page_by, limit, after)
+
+            if handle.stream:
+                if format == 'msgpack':
+                    raise RuntimeError("MessagePack responses cannot be "
+                                       "streamed")
+                response = self._stream(procname, procargs, format,
+                    handle.batch_size, mode, timer, timeout, call, shard,
+                    handle.max_in_flight)
+                if negotiated:
+                    response.vary.add('Accept')
+                return response
+
+            options = dict(etag=handle.etag, cache_control=handle.cache_control,
+                           compress=handle.compress,
+                           vary=('Accept',) if negotiated else (),
+                           timer=timer)
+
+            key = None
+            if self._cacheable(signature, handle.cache):
+                # The shard key may not be among the arguments
+                key = (procname, format,
+                       simplejson.dumps(procargs, default=dthandler), page,
+                       shard_name, handle.scatter)
+                body = self.cache.get(key)
+                if body is not None:
+                    timer.mark('cache')
+                    timer.count(size=len(body))
+                    return self._respond(body, format, **options)
+
+            # Rows are counted with a LIMIT clause, and a server-side
+            # cursor is only needed to stop fetching past max_bytes
+            max_rows = handle.max_rows if page is None else None
+            max_bytes = handle.max_bytes if page is None else None
+            truncate = handle.on_limit == 'truncate'
+            server_json = handle.server_json and format in _json_statements \
+                and max_rows is None and max_bytes is None
+            def run():
+                slot = self._acquire_slot(procname, handle.max_in_flight)
+                try:
+                    if handle.scatter:
+                        return self._scatter(procname, procargs, format, mode,
+                            timer, timeout, call, max_rows, max_bytes,
+                            truncate)
+                    if max_bytes is not None:
+                        return self._run_guarded(procname, procargs, format,
+                            mode, timer, timeout, call, shard, max_rows,
+                            max_bytes, truncate)
+                    return self._run(procname, procargs, format, server_json,
+                                     mode, handle.prepare, timer, page,
+                                     timeout, call, shard, max_rows, truncate)
+                finally:
+                    if slot is not None:
+                        slot.release()
+
+            if handle.coalesce and mode == 'readonly' and \
+                    not getattr(stack.top, 'moresql_transaction', False):
+                (body, truncated), shared = self.coalescer.call((procname,
+                    format, simplejson.dumps(procargs, default=dthandler),
+                    page, server_json, shard_name, handle.scatter), run)
+                if shared:
+                    timer.mark('coalesce')
+                    timer.count(size=len(body))
             else:
-                result = result[0]
+                body, truncated = run()
+
+            if truncated:
+                response = self._respond(body, format, **options)
+                response.headers['X-MoreSQL-Truncated'] = 'true'
+                return response
+
+            if key is not None:
+                self._start_listener()
+                self.cache.set(key, body, handle.cache_ttl)
+
+            return self._respond(body, format, **options)
+
+    def execute_many(self, calls, transaction=None, timeout=None):
+        """Execute several stored procedures in a single round trip. Return
+        a JSON object mapping each call name to its result::
+
+            return db.execute_many([
+                ('dog', 'get_dog', [ 'dog_id' ]),
+                ('owner', 'get_owner', [ 'dog_id' ]),
+                ('visits', 'get_visits', [ 'dog_id' ], { 'dog_id': 42 }),
+            ])
+
+        :param calls: a list of ``(name, procname, fields, values)`` tuples,
+                      where `fields` and `values` are optional and have the
+                      same meaning as in :meth:`execute`
+        :param transaction: the transaction mode, as in :meth:`execute`.
+                            Defaults to ``'readonly'`` if all the procedures
+                            are read-only, and to ``'autocommit'`` otherwise
+        :param timeout: the timeout of the whole batch, as in
+                        :meth:`execute`. Defaults to `MORESQL_TIMEOUT`
+
+        Each result is shaped as it would have been by :meth:`execute`. All
+        the procedures are called in order within a single SQL statement,
+        which is atomic on its own. `STABLE` and `IMMUTABLE` procedures see
+        the database as it was at the beginning of the statement.
+        """
+        timer = self._timer(','.join([ call[1] for call in calls ]),
+                            self.app.config['MORESQL_SLOW_CALL'])
+        with timer:
+            return self._execute_many(calls, transaction, timeout, timer)
+
+    def _execute_many(self, calls, transaction, timeout, timer):
+        names, statements, procargs = [], [], []
+        readonly = True
+
+        for call in calls:
+            name, procname = call[:2]
+            fields = call[2] if len(call) > 2 else None
+            values = call[3] if len(call) > 3 else None
+
+            try:
+                args, signature = _get_procedure_arguments(fields, values,
+                    self.signatures(procname))
+            except ValueError as e:
+                abort(400, str(e))
+
+            names.append(name)
+            statements.append('(%s)' % _json_statement(
+                _call_statement(procname, len(args)), 'json'))
+            procargs.extend(args)
+
+            mode = self._transaction_mode(signature, self._option(procname,
+                'transaction', None, self.app.config['MORESQL_TRANSACTION']))
+            if mode != 'readonly':
+                readonly = False
+
+        if transaction is None:
+            transaction = 'readonly' if readonly else 'autocommit'
+
+        if timeout is None:
+            timeout = self.app.config['MORESQL_TIMEOUT']
+
+        timer.mark('bind')
+        connection = self._route(transaction, timeout)
+        timer.mark('pool')
+        commit = self._begin(connection, transaction, timeout=timeout)
+
+        cursor = connection.cursor()
+        self._execute(cursor, 'SELECT ' + ', '.join(statements), procargs,
+                      self.app.config['MORESQL_PREPARE'], timeout)
+        timer.mark('call')
+        results = cursor.fetchone()
+        timer.mark('fetch')
+
+        if commit:
+            connection.commit()
+            timer.mark('commit')
+
+        body = '{%s}' % ', '.join([ '%s: %s' % (simplejson.dumps(name), result)
+            for name, result in zip(names, results) ])
+        timer.mark('serialize')
+        timer.count(size=len(body))
+
+        config = self.app.config
+        return self._respond(body, 'json', config['MORESQL_ETAG'],
+                             config['MORESQL_CACHE_CONTROL'],
+                             config['MORESQL_COMPRESS'], timer=timer)
+
+    def execute_bulk(self, procname, table, columns=None, format='csv',
+                     header=False, fields=None, values=None, source=None):
+        """Load many rows at once and pass them to a set-based stored
+        procedure. Return a JSON HTTP response summarizing the load.
+
+        Rows are read from the request body, converted on the fly and copied
+        with ``COPY ... FROM STDIN`` into a temporary ``moresql_staging``
+        table shaped like `table`. The stored procedure is then called in
+        the same transaction, and is expected to process the staged rows::
+
+            @app.route('/dogs/import', methods=['POST'])
+            def import_dogs():
+                return db.execute_bulk('import_dogs', 'dogs',
+                                       columns=[ 'name', 'breed' ])
+
+        :param procname: the stored procedure name
+        :param table: the table whose columns the staging table copies
+        :param columns: the columns the values of each row are loaded into.
+                        Defaults to the header of CSV documents if `header`
+                        is true, and otherwise to all the columns of `table`
+        :param format: ``'csv'`` (the default) or ``'ndjson'``, one JSON
+                       object per line. Empty CSV fields and missing NDJSON
+                       keys are loaded as NULL
+        :param header: whether the first CSV line is a header
+        :param fields: the stored procedure parameters, as in :meth:`execute`
+        :param values: as in :meth:`execute`
+        :param source: a file-like object, or any iterable of lines, to read
+                       rows from instead of the request body
+
+        The response is a JSON object with the number of rows `accepted` and
+        `rejected`, the `errors` of the first rejected rows with their line
+        numbers, and the `result` of the stored procedure, shaped as by
+        :meth:`execute`. Rows that cannot be parsed are rejected, while values
+        not matching the type or constraints of their column abort the whole
+        load with a ``400 Bad Request`` error.
+        """
+        slow = self._option(procname, 'slow_call', None,
+                            self.app.config['MORESQL_SLOW_CALL'])
+        with self._timer(procname, slow) as timer:
+            if format not in ('csv', 'ndjson'):
+                raise RuntimeError("Unsupported input format '%s'" % format)
+            if not _procname_re.match(table):
+                raise RuntimeError("Invalid table name '%s'" % table)
+
+            try:
+                procargs, signature = _get_procedure_arguments(fields, values,
+                    self.signatures(procname))
+            except ValueError as e:
+                abort(400, str(e))
+
+            timer.mark('bind')
+            connection = self._route('commit')
+            timer.mark('pool')
+            commit = self._begin(connection, 'commit')
+
+            cursor = connection.cursor(
+                cursor_factory=psycopg2.extras.RealDictCursor)
+            try:
+                source = self._copy(cursor, table, columns, format, header,
+                                    source if source is not None
+                                    else request.stream)
+                timer.mark('copy')
+
+                cursor.execute(_call_statement(procname, len(procargs)),
+                               procargs)
+                result = _unwrap(cursor.fetchall())
+                cursor.execute('DROP TABLE %s' % _staging_table)
+                timer.mark('call')
+            except (psycopg2.DataError, psycopg2.IntegrityError) as e:
+                # Invalid values sent by the client, or missing required ones
+                if commit:
+                    connection.rollback()
+                abort(400, str(e))
+
+            if commit:
+                connection.commit()
+                timer.mark('commit')
+
+            body = simplejson.dumps({
+                'accepted': source.accepted,
+                'rejected': source.rejected,
+                'errors': source.errors,
+                'result': result,
+            }, default=dthandler)
+            timer.mark('serialize')
+            timer.count(source.accepted, len(body))
+
+            return self._respond(body, 'json')
+
+    def _copy(self, cursor, table, columns, format, header, lines):
+        """Copy the rows read from `lines` into a new staging table shaped
+        like `table`, and return the :class:`_CopySource` they went
+        through."""
+        cursor.execute('CREATE TEMPORARY TABLE %s '
+                       '(LIKE %s INCLUDING DEFAULTS) ON COMMIT DROP' %
+                       (_staging_table, table))
+
+        if format == 'csv':
+            records = _csv_records(lines)
+            if header:
+                names = next(records, (None, [], None))[1]
+                if columns is None:
+                    columns = names
+
+        if columns is None:
+            cursor.execute('SELECT * FROM %s LIMIT 0' % _staging_table)
+            columns = [ column[0] for column in cursor.description ]
+
+        for column in columns:
+            if column is None or not _identifier_re.match(column):
+                abort(400, "Invalid column name '%s'" % column)
+
+        if format == 'ndjson':
+            records = _ndjson_records(lines, columns)
+
+        source = _CopySource(records, len(columns))
+        cursor.copy_expert("COPY %s (%s) FROM STDIN WITH CSV NULL '\\N'" % (
+            _staging_table, ', '.join(columns)), source)
+        return source
+
+    def _execute(self, cursor, statement, args, prepare=False, timeout=None):
+        """Execute the given statement, within the given timeout as enforced
+        by :meth:`_watch`."""
+        with self._watch(cursor.connection, timeout):
+            if prepare:
+                _execute_prepared(cursor, statement, args,
+                                  self.app.config['MORESQL_PREPARED_MAX'])
+            else:
+                cursor.execute(statement, args)
+
+    @contextlib.contextmanager
+    def _watch(self, conn, timeout):
+        """Run the block, in which queries are sent on `conn`. If `timeout`
+        is given, these queries are cancelled by the client should
+        `statement_timeout` fail to stop them in time, and
+        :class:`CallTimeout` is raised."""
+        if timeout is None:
+            yield
+            return
+
+        key = self._watchdog.watch(conn, timeout + _cancel_grace)
+        try:
+            yield
+        except psycopg2.extensions.QueryCanceledError as e:
+            if not getattr(stack.top, 'moresql_transaction', False):
+                # Leave the connection usable by the next calls
+                conn.rollback()
+            raise CallTimeout(str(e).strip())
+        finally:
+            self._watchdog.unwatch(key)
+
+    def _shard_pool(self, field, values=None, view_args=None):
+        """Return the name and the pool of the shard the current call should
+        run on, given the name of its shard key field."""
+        if values:
+            key = values.get(field)
+        elif view_args and field in view_args:
+            key = view_args[field]
+        else:
+            key = request.values.get(field)
+        if key is None:
+            abort(400, "Missing shard key '%s'" % field)
+
+        try:
+            name = self.shard(key)
+        except ValueError as e:
+            abort(400, str(e))
+
+        pool = self.shards.get(name)
+        if pool is None:
+            raise RuntimeError("Unknown shard '%s'" % name)
+        return name, pool
+
+    def _register_typecasters(self, cursor):
+        """Decode the values fetched by the given cursor into JSON-ready
+        types, leaving the other cursors of the connection alone."""
+        for typecaster in self._typecasters:
+            psycopg2.extensions.register_type(typecaster, cursor)
+
+    def _page(self, page_by, limit, after):
+        """Return the ``(columns, descending, keys, limit)`` tuple describing
+        the requested page."""
+        columns = [ page_by ] if isinstance(page_by, basestring) \
+            else list(page_by)
+
+        descending = [ column.startswith('-') for column in columns ]
+        if any(descending) and not all(descending):
+            raise RuntimeError("Pages cannot mix ascending and descending "
+                               "orders")
+        columns = tuple([ column.lstrip('-') for column in columns ])
+        for column in columns:
+            if not _identifier_re.match(column):
+                raise RuntimeError("Invalid column name '%s'" % column)
+
+        config = self.app.config
+        if limit is None and has_request_context():
+            limit = request.values.get('limit')
+            if limit is not None:
+                try:
+                    limit = min(int(limit), config['MORESQL_PAGE_MAX_SIZE'])
+                except ValueError:
+                    abort(400, 'Invalid page size')
+        if limit is None:
+            limit = config['MORESQL_PAGE_SIZE']
+        if limit < 1:
+            abort(400, 'Invalid page size')
+
+        if after is None and has_request_context():
+            after = request.values.get('after')
+
+        keys = None
+        if after:
+            try:
+                keys = _decode_token(after, len(columns))
+            except ValueError as e:
+                abort(400, str(e))
+
+        return columns, all(descending), keys, limit
+
+    def _run(self, procname, procargs, format, server_json=False,
+             mode='commit', prepare=False, timer=_null_timer, page=None,
+             timeout=None, call=None, shard=None, max_rows=None,
+             truncate=False):
+        """Call the given stored procedure, on the given shard pool if any,
+        and return its serialized result, or the requested page of it, and
+        whether it has been truncated to `max_rows` rows. Raise
+        :class:`ResultTooLarge` if the procedure returns more rows, unless
+        `truncate` is true."""
+        if call is None:
+            call = _call_statement(procname, len(procargs))
+
+        if shard is not None:
+            connection = self._checkout(shard, timeout)
+        else:
+            connection = self._route(mode, timeout)
+        if timer.slow is not None:
+            timer.pool = self._pool_of(connection)
+        timer.mark('pool')
+        commit = self._begin(connection, mode, timeout=timeout)
+
+        if page is not None:
+            columns, descending, keys, limit = page
+            cursor = connection.cursor(
+                cursor_factory=psycopg2.extras.RealDictCursor)
+            statement = _page_statement(call, columns, descending, keys)
+            # One more row tells whether there is a next page
+            procargs = procargs + list(keys or ()) + [ limit + 1 ]
+        elif server_json:
+            cursor = connection.cursor()
+            statement = _json_statement(call, format)
+        elif format in _tuple_formats:
+            cursor = connection.cursor()
+            statement = call
+        else:
+            cursor = connection.cursor(
+                cursor_factory=psycopg2.extras.RealDictCursor)
+            statement = call
+        if max_rows is not None:
+            # One more row tells whether the limit is exceeded
+            statement += ' LIMIT %d' % (max_rows + 1)
+        self._register_typecasters(cursor)
+
+        try:
+            self._execute(cursor, statement, procargs, prepare, timeout)
+        except psycopg2.ProgrammingError as e:
+            if e.pgcode == '42883':
+                # Undefined function: the cached signatures may be stale
+                self.refresh_signatures(procname)
+            raise
+
+        timer.mark('call')
+
+        exceeded = max_rows is not None and cursor.rowcount > max_rows
+        if exceeded and not truncate:
+            if commit:
+                connection.rollback()
+            raise ResultTooLarge("The result of %s has more than %d rows" %
+                                 (procname, max_rows))
+
+        if commit:
+            connection.commit()
+            timer.mark('commit')
+
+        if server_json and page is None:
+            body = cursor.fetchone()[0]
+            timer.mark('fetch')
+            timer.count(size=len(body))
+            return body, False
+
+        # OUT parameters are returned as columns of the result set
+        result = cursor.fetchall()
+        timer.mark('fetch')
+
+        if max_rows is not None:
+            document = _LimitedDocument(format, max_rows)
+            document.add(result)
+            result = result[:max_rows]
+            body = document.body(_columns(cursor)
+                                 if format in _tuple_formats else None)
+        elif page is not None:
+            rows = result[:limit]
+            token = None
+            if len(result) > limit:
+                token = _encode_token([ rows[-1][column]
+                                        for column in columns ])
+            body = simplejson.dumps({ 'rows': rows, 'next': token },
+                                    default=dthandler)
+        else:
+            body = _serialize(result, format, cursor)
+
+        timer.mark('serialize')
+        timer.count(len(result), len(body))
+        return body, exceeded
+
+    def _run_guarded(self, procname, procargs, format, mode='commit',
+                     timer=_null_timer, timeout=None, call=None, shard=None,
+                     max_rows=None, max_bytes=None, truncate=False):
+        """Call the given stored procedure through a server-side cursor,
+        fetching and serializing rows in batches as long as there are no
+        more than `max_rows` of them, and no more than `max_bytes` bytes.
+        Return the serialized result, and whether it has been truncated to
+        these limits. Raise :class:`ResultTooLarge` if a limit is exceeded,
+        unless `truncate` is true."""
+        if call is None:
+            call = _call_statement(procname, len(procargs))
+
+        if shard is not None:
+            connection = self._checkout(shard, timeout)
+        else:
+            connection = self._route(mode, timeout)
+        if timer.slow is not None:
+            timer.pool = self._pool_of(connection)
+        timer.mark('pool')
+
+        # Server-side cursors only live within transactions
+        commit = self._begin(connection, mode, autocommit=False,
+                             timeout=timeout)
+
+        statement = call
+        batch_size = self.app.config['MORESQL_STREAM_BATCH_SIZE']
+        if max_rows is not None:
+            # One more row tells whether the limit is exceeded
+            statement += ' LIMIT %d' % (max_rows + 1)
+            batch_size = min(batch_size, max_rows + 1)
+
+        cursor = connection.cursor('moresql_%d' % next(self._cursor_names),
+            cursor_factory=None if format in _tuple_formats
+                else psycopg2.extras.RealDictCursor)
+        self._register_typecasters(cursor)
+
+        document = _LimitedDocument(format, max_rows, max_bytes)
+
+        # The procedure runs as rows are fetched, not when the cursor is
+        # declared: the whole loop is bound by the timeout
+        with self._watch(connection, timeout):
+            cursor.execute(statement, procargs)
+            timer.mark('call')
+
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows or not document.add(rows):
+                    break
+
+            columns = _columns(cursor) if format in _tuple_formats else None
+            # Stops the procedure if it is still running
+            cursor.close()
+        timer.mark('fetch')
+
+        if document.exceeded is not None and not truncate:
+            if commit:
+                connection.rollback()
+            raise ResultTooLarge("The result of %s has %s" % (procname,
+                document.exceeded))
+        if commit:
+            connection.commit()
+            timer.mark('commit')
+
+        body = document.body(columns)
+        timer.mark('serialize')
+        timer.count(document.count, len(body))
+        return body, document.exceeded is not None
+
+    def _scatter(self, procname, procargs, format, mode='commit',
+                 timer=_null_timer, timeout=None, call=None, max_rows=None,
+                 max_bytes=None, truncate=False):
+        """Call the given stored procedure on all the shards in parallel, and
+        return the serialized concatenation of their results, in the order
+        of the shard names, and whether it has been truncated to `max_rows`
+        rows and `max_bytes` bytes. Raise :class:`ResultTooLarge` if a limit
+        is exceeded, unless `truncate` is true."""
+        if call is None:
+            call = _call_statement(procname, len(procargs))
+
+        statement = call
+        if max_rows is not None:
+            # No shard needs to send more rows than the whole result holds
+            statement += ' LIMIT %d' % (max_rows + 1)
+
+        shards = [ pool for name, pool in sorted(self.shards.items()) ]
+        if not shards:
+            raise RuntimeError("No shards configured")
+        results = [ None ] * len(shards)
+        errors = []
+
+        def fetch(pos, pool):
+            try:
+                conn = pool.getconn(timeout and min(timeout, pool.timeout))
+                try:
+                    commit = self._begin(conn, mode, timeout=timeout)
+                    cursor = conn.cursor(cursor_factory=None
+                        if format in _tuple_formats
+                        else psycopg2.extras.RealDictCursor)
+                    self._register_typecasters(cursor)
+                    self._execute(cursor, statement, procargs,
+                                  timeout=timeout)
+                    if max_rows is not None and not truncate and \
+                            cursor.rowcount > max_rows:
+                        if commit:
+                            conn.rollback()
+                        raise ResultTooLarge("The result of %s has more "
+                            "than %d rows" % (procname, max_rows))
+                    results[pos] = cursor, cursor.fetchall()
+                    if commit:
+                        conn.commit()
+                finally:
+                    pool.putconn(conn)
+            except:
+                errors.append(sys.exc_info())
+
+        # Each shard is called by a thread of its own, the first one by the
+        # current thread
+        threads = [ threading.Thread(target=fetch, args=(pos, pool))
+                    for pos, pool in enumerate(shards) if pos > 0 ]
+        for thread in threads:
+            thread.start()
+        fetch(0, shards[0])
+        for thread in threads:
+            thread.join()
+        timer.mark('call')
+
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+
+        rows = []
+        for cursor, result in results:
+            rows.extend(result)
+
+        if max_rows is None and max_bytes is None:
+            body = _serialize(rows, format, results[0][0])
+            timer.mark('serialize')
+            timer.count(len(rows), len(body))
+            return body, False
+
+        document = _LimitedDocument(format, max_rows, max_bytes)
+        document.add(rows)
+        if document.exceeded is not None and not truncate:
+            raise ResultTooLarge("The result of %s has %s" % (procname,
+                document.exceeded))
+
+        body = document.body(_columns(results[0][0])
+                             if format in _tuple_formats else None)
+        timer.mark('serialize')
+        timer.count(document.count, len(body))
+        return body, document.exceeded is not None
+
+    def _negotiate_format(self, paged=False, stream=False):
+        """Return the output format preferred by the client."""
+        if paged or not has_request_context():
+            return 'json'
+
+        formats = [ format for format in _formats
+            if format != 'msgpack' or (msgpack is not None and not stream) ]
+        mimetypes = [ _mimetypes[format] for format in formats ]
+
+        best = request.accept_mimetypes.best_match(mimetypes)
+        if best is None:
+            return 'json'
+        return formats[mimetypes.index(best)]
+
+    def _respond(self, body, format, etag=False, cache_control=None,
+                 compress=False, vary=(), timer=_null_timer):
+        """Return the response carrying the given serialized result,
+        conditional and compressed as requested."""
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+
+        encoding = None
+        compressible = compress and \
+            len(body) >= self.app.config['MORESQL_COMPRESS_MIN_SIZE']
+        if compressible and has_request_context():
+            encoding = request.accept_encodings.best_match([ 'gzip',
+                                                             'deflate' ])
+
+        tag = None
+        if etag:
+            # Each content coding is a representation of its own
+            tag = hashlib.md5(body).hexdigest()
+            if encoding is not None:
+                tag += '-' + encoding
+
+        if tag is not None and has_request_context() and \
+                request.method in ('GET', 'HEAD') and \
+                request.if_none_match.contains_weak(tag):
+            response = make_response('', 304)
+        else:
+            if encoding is not None:
+                body = _compress(body, encoding,
+                                 self.app.config['MORESQL_COMPRESS_LEVEL'])
+                timer.mark('compress')
+
+            response = make_response(body)
+            if encoding is not None:
+                response.headers['Content-Encoding'] = encoding
+
+        response.mimetype = _mimetypes[format]
+        for header in vary:
+            response.vary.add(header)
+        if compressible:
+            response.vary.add('Accept-Encoding')
+        if tag is not None:
+            response.set_etag(tag)
+        if cache_control is not None:
+            response.headers['Cache-Control'] = cache_control
+
+        return response
+
+    def _stream(self, procname, procargs, format, batch_size, mode,
+                timer=_null_timer, timeout=None, call=None, shard=None,
+                max_in_flight=None):
+        """Return a response streaming the rows returned by the given stored
+        procedure, fetching `batch_size` rows at a time, unless
+        `max_in_flight` calls to it are already running."""
+        if batch_size is None:
+            batch_size = self.app.config['MORESQL_STREAM_BATCH_SIZE']
+        if call is None:
+            call = _call_statement(procname, len(procargs))
+
+        slot = self._acquire_slot(procname, max_in_flight)
+        try:
+            if shard is not None:
+                connection = self._checkout(shard, timeout)
+            else:
+                connection = self._route(mode, timeout)
+            if timer.slow is not None:
+                timer.pool = self._pool_of(connection)
+            timer.mark('pool')
+
+            # Server-side cursors only live within transactions
+            commit = self._begin(connection, mode, autocommit=False,
+                                 timeout=timeout)
+
+            cursor = connection.cursor(
+                'moresql_%d' % next(self._cursor_names),
+                cursor_factory=None if format in _tuple_formats
+                    else psycopg2.extras.RealDictCursor)
+            self._register_typecasters(cursor)
+            self._execute(cursor, call, procargs, timeout=timeout)
+            timer.mark('call')
+        except:
+            if slot is not None:
+                slot.release()
+            raise
+
+        # The call is over once the response has been sent
+        timer.defer()
+
+        def generate():
+            try:
+                first = True
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    timer.mark('fetch')
+                    if first:
+                        # Column names are only known once rows are fetched
+                        yield _document_start(format, _columns(cursor))
+                    if not rows:
+                        break
+
+                    chunk = _dump_rows(rows, format, first)
+                    timer.mark('serialize')
+                    timer.count(len(rows), len(chunk))
+
+                    yield chunk
+                    timer.mark('send')
+                    first = False
+
+                yield _document_ends.get(format, '')
+
+                cursor.close()
+                if commit:
+                    connection.commit()
+                    timer.mark('commit')
+            except:
+                if commit:
+                    connection.rollback()
+                timer.finish(sys.exc_info()[1])
+                raise
+
+            timer.finish()
 
-        return make_response(simplejson.dumps(result, default=dthandler))
+        # Keep the context, and therefore the connection, around until the
+        # whole response has been sent
+        response = self.app.response_class(stream_with_context(generate()),
+                                           mimetype=_mimetypes[format])
+        if slot is not None:
+            response.call_on_close(slot.release)
+        return response
@@ -25,7 +25,11 @@ setup(
     py_modules=['flask_moresql', 'tests',],
     zip_safe=False,
     platforms='any',
-    install_requires=[ 'Flask', 'psycopg2', 'simplejson' ],
+    install_requires=[ 'Flask', 'psycopg2', 'simplejson>=3.12' ],
+    extras_require={
+        'msgpack': [ 'msgpack-python' ],
+        'gevent': [ 'gevent' ],
+    },
     test_suite='tests',
     classifiers=[
         'Development Status :: 4 - Beta',